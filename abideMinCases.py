@@ -1,21 +1,34 @@
 # -*- coding: utf-8 -*-
 
-import processing
 from PyQt5.QtCore import (QCoreApplication)
-from qgis.core import (QgsProcessing,
+from qgis.core import (NULL,
+                       QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterField,
                        QgsProcessingParameterFileDestination,
                        QgsMessageLog,
-                       QgsVectorFileWriter,
                        QgsProcessingParameterString,
-                       QgsProcessingFeatureSourceDefinition,
-                       QgsProcessingUtils,
-                       QgsVectorLayer,
-                       QgsProject)
-from qgis.gui import QgsMapCanvas
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingOutputNumber,
+                       QgsFeatureRequest,
+                       QgsProcessingContext)
+import numpy as np
 import os
+import sys
+
+# make the helper modules next to this script importable
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+if scriptDir not in sys.path:
+    sys.path.append(scriptDir)
+
+from adjacencyGraph import (buildAdjacencyGraph,
+                            cachedAdjacencyGraph)
+from minCasesEngine import (abideMinCases as abideMinCases_func,
+                            abideMinCasesParallel)
+from gpkgWriter import writeLayer
+from processingMonitor import ProcessingMonitor
 
 
 class abideMinCases(QgsProcessingAlgorithm):
@@ -28,7 +41,12 @@ class abideMinCases(QgsProcessingAlgorithm):
     colApply = 'colApply'
     thresh = 'thresh'
     maxIter = 'maxIter'
+    converge = 'converge'
+    processes = 'processes'
+    useCache = 'useCache'
     OUTPUT = 'output'
+    stageReport = 'stageReport'
+    ITERATIONS = 'iterations'
     
 
     def initAlgorithm(self, config = None):
@@ -67,6 +85,33 @@ class abideMinCases(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.converge,
+                self.tr('Iteration bei Konvergenz vorzeitig beenden'),
+                False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.processes,
+                self.tr('Anzahl paralleler Prozesse (0 = alle Prozessorkerne)'),
+                QgsProcessingParameterNumber.Integer,
+                1,
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.useCache,
+                self.tr('Nachbarschaften neben dem Eingabedatensatz zwischenspeichern'),
+                True
+            )
+        )
+        
        
         self.addParameter(
             QgsProcessingParameterFileDestination(
@@ -76,6 +121,23 @@ class abideMinCases(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.stageReport,
+                self.tr('Laufzeitbericht'),
+                fileFilter = '*.json',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        self.addOutput(
+            QgsProcessingOutputNumber(
+                self.ITERATIONS,
+                self.tr('Anzahl der genutzten Iterationen')
+            )
+        )
+        
         
     def processAlgorithm(self, parameters, context, feedback):
         
@@ -84,163 +146,80 @@ class abideMinCases(QgsProcessingAlgorithm):
         colApply = self.parameterAsFields(parameters, self.colApply, context)
         thresh = self.parameterAsString(parameters, self.thresh, context)
         maxIter = self.parameterAsString(parameters, self.maxIter, context)
+        converge = self.parameterAsBool(parameters, self.converge, context)
+        processes = self.parameterAsInt(parameters, self.processes, context)
+        useCache = self.parameterAsBool(parameters, self.useCache, context)
         outPath = self.parameterAsString(parameters, self.OUTPUT, context)
+        reportPath = self.parameterAsFileOutput(parameters, self.stageReport, context)
         
         
         
         
-        # create output layer from input data
-        outTab = QgsVectorLayer('Polygon', 'outTab', 'memory')
-        CRS = inputTab.crs()
-        outTab.setCrs(CRS)
-        outTab.dataProvider().addAttributes(inputTab.dataProvider().fields().toList())
-        outTab.updateFields()
-        feats = [feat for feat in inputTab.getFeatures()]
-        outTab.dataProvider().addFeatures(feats)
-        outTab.updateExtents()
+        # set up progress reporting and stage timing
+        monitor = ProcessingMonitor(feedback, self.name(), 4)
+        
         
-
         # redefine data types
         thresh = float(thresh)
         maxIter = int(maxIter)
         
-        # generate temp folder
-        QgsMessageLog.logMessage('Creating temporary output directory...', 'User notification', 0)
-        tempDir = QgsProcessingUtils.tempFolder()
-        if not os.path.exists(tempDir):
-            os.makedirs(tempDir)
+        # derive the neighbourhood of all features once
+        with monitor.stage('adjacency graph') as stage:
+            if useCache:
+                graph = cachedAdjacencyGraph(inputTab, inputTab, monitor)
+            else:
+                graph = buildAdjacencyGraph(inputTab, monitor)
+            stage.features = len(graph)
         
             
         
         # get field indices of interest
-        QgsMessageLog.logMessage('Getting field names and indeces...', 'User notification', 0)
         fieldIdx = []
-        fieldNames = outTab.fields().names()
+        fieldNames = inputTab.fields().names()
         for f in list(range(0, len(fieldNames))):
             if fieldNames[f] in colApply:
                 fieldIdx.append(fieldNames.index(fieldNames[f]))       
         
           
         
-        def abideMinCases_func():
+        # load the values of interest once into arrays ordered like the graph
+        with monitor.stage('load values') as stage:
+            values = np.full((len(fieldIdx), len(graph)), np.nan)
+            request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(fieldIdx)
+            for feat in inputTab.getFeatures(request):
+                pos = graph.position[feat.id()]
+                for v in list(range(0, len(fieldIdx))):
+                    val = feat[fieldIdx[v]]
+                    if val is not None and val != NULL:
+                        values[v, pos] = float(val)
+                stage.features += 1
+                monitor.progress(stage.features, len(graph))
         
-            # create container for information about processed features
-            allProc = []
-            
-            # iterate over each feature
-            feats = outTab.getFeatures()
-            feat_iter_count = 0
-            n_feats = outTab.featureCount()
-            for feat in feats:
-                
-                feat_iter_count += 1
-                QgsMessageLog.logMessage('Processing feature...(' + str(feat_iter_count) + '/' + str(n_feats) + ')', 'User notification', 0)
-                
-                # get attributes
-                atts = feat.attributes()
-                
-                # iterate over fields of interest
-                for a in list(range(0, len(atts))):
-                    
-                    QgsMessageLog.logMessage('Processing field...(' + str(a+1) + '/' + str(len(atts)) + ')', 'User notification', 0)
-                    
-                    # get active if current field is within the fields of interest
-                    if a in fieldIdx:
-                        
-    
-                        # extract value in question and area size for the respective features
-                        to_val = atts[a]
-                        
-                        # get active if attribute value is lower than defined threshold
-                        if atts[a] < thresh:
-                            
-                            # select current feature and create new layer
-                            outTab.selectByIds([feat.id()])
-                            temp_fileName = tempDir + '/temp_selected_' + str(feat_iter_count) + '_' + str(a) + '.gpkg'
-                            QgsVectorFileWriter.writeAsVectorFormat(outTab, temp_fileName, 'ANSI', outTab.crs(), 'GPKG', 1)
-            
-                            
-                            
-                            # get adjacent features
-                            params = {'INPUT' : outTab,
-                                      'INTERSECT' : QgsProcessingFeatureSourceDefinition(temp_fileName, False),
-                                      'METHOD' : 0,
-                                      'PREDICATE' : [4] }
-                            adjSel = processing.run('native:selectbylocation', params)['OUTPUT']
-                            adj_feats = adjSel.selectedFeatures()
-                            adjSel.removeSelection()
-                            
-                            
-                            # get attribute values of adjacent features
-                            adjIdx = []
-                            adjAtts = []
-                            for adj_feat in adj_feats:
-                                adjIdx.append(adj_feat.id())
-                                adjAtts.append(adj_feat[a])
-                            
-                            QgsMessageLog.logMessage('Feature comparison with ' + str(len(adjIdx)) + ' adjacent features...', 'User notification', 0)
-                            
-                            
-                            # sort adjacent features by attribute values
-                            adjIdx = [x for _, x in sorted(zip(adjAtts, adjIdx))]
-                            adjAtts = sorted(adjAtts)
-                                                        
-                            
-                            # iterate over each appropriate adjacent feature pair as long as the threshold is not reached
-                            new_val = to_val
-                            for p in list(range(0, len(adjIdx))):
-                                 
-                                 
-                                # collect information about current feature pair
-                                pair1 = str(feat.id()) + '_' + str(adjIdx[p])
-                                pair2 = str(adjIdx[p]) + '_' + str(feat.id())
-                                 
-                                 
-                                # get active if this feature pair has not been processed before
-                                if (pair1 not in allProc) and (pair2 not in allProc) and (new_val < thresh):
-                                       
-                                    # get values of adjacent polygon 
-                                    outTab.selectByIds([adjIdx[p]])
-                                    comp_val = outTab.selectedFeatures()[0].attributes()[a]
-                                    outTab.removeSelection()
-       
-                                    # calculate new value as mean
-                                    new_val = (to_val + comp_val) / 2
-                                        
-                                                                        
-                                    # update attribute values in respective features
-                                    outTab.startEditing()
-                                    outTab.changeAttributeValue(adjIdx[p], a, new_val)
-                                    outTab.changeAttributeValue(feat.id(), a, new_val)
-                                    outTab.commitChanges()
-                                    
-                                         
-                                     
-                                    # collect information about this processed feature pair
-                                    allProc.append(pair1)
-                                    
-                                    # update value in question
-                                    to_val = new_val
-                                                                
-                                
-            return outTab
-                
-        # execute function
-        for l in list(range(0, maxIter)):
-            QgsMessageLog.logMessage('Start iterative processing...(' + str(l+1) + '/' + str(maxIter) + ')', 'User notification', 0)
-            outTab = abideMinCases_func()
         
-        # write to file
-        QgsMessageLog.logMessage('Writing results to file...', 'User notification', 0)
-        QgsVectorFileWriter.writeAsVectorFormat(outTab, outPath, 'ANSI', CRS, 'GPKG')
-        
-        
-        # add the new layer to canvas
-        QgsProject.instance().addMapLayer(outTab)
-        QgsMapCanvas().setExtent(outTab.extent())
-        QgsMapCanvas().setLayers([outTab])
-        
-        return {self.OUTPUT: outTab}
+        # execute function
+        with monitor.stage('smoothing') as stage:
+            if processes == 1:
+                newValues, usedIter = abideMinCases_func(values, graph.indptr, graph.indices, thresh, maxIter, converge,
+                                                         monitor.progress)
+            else:
+                newValues, usedIter = abideMinCasesParallel(values, graph.indptr, graph.indices, thresh, maxIter, converge,
+                                                            processes, monitor.progress)
+            stage.features = len(graph)
+        QgsMessageLog.logMessage('Iterations used: ' + str(usedIter) + '/' + str(maxIter), 'User notification', 0)
+        
+        
+        # stream the input features with the smoothed values straight into the output
+        with monitor.stage('write') as stage:
+            changed = np.where((newValues != values) & ~np.isnan(newValues), newValues, np.nan)
+            stage.features = writeLayer(inputTab, outPath, [fieldNames[f] for f in fieldIdx], changed, graph.fids,
+                                        keepMissing = True, monitor = monitor)
+        monitor.writeReport(reportPath)
+        
+        # let the processing framework load the result when run from QGIS
+        context.addLayerToLoadOnCompletion(outPath, QgsProcessingContext.LayerDetails('outTab', context.project(),
+                                                                                      self.OUTPUT))
+        
+        return {self.OUTPUT: outPath, self.ITERATIONS: usedIter}
     
 
     def name(self):
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Polygon adjacency graph used by the smoothing tools.
+
+The graph is built once per run with a spatial index and stored in compressed
+sparse row (CSR) form: the neighbours of the feature at position i are
+indices[indptr[i]:indptr[i + 1]], where positions refer to the fids array.
+"""
+
+from qgis.core import (QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsSpatialIndex)
+import numpy as np
+
+from geometryCache import (layerFingerprint,
+                           loadCachedArray,
+                           sidecarStem,
+                           storeCachedArray)
+
+
+class AdjacencyGraph(object):
+
+    """
+    Compact CSR neighbour arrays keyed by feature id
+    """
+
+    def __init__(self, fids, indptr, indices):
+        self.fids = np.asarray(fids, dtype = np.int64)
+        self.indptr = np.asarray(indptr, dtype = np.int64)
+        self.indices = np.asarray(indices, dtype = np.int64)
+        self.position = {int(fid): i for i, fid in enumerate(self.fids)}
+
+    def __len__(self):
+        return len(self.fids)
+
+    def neighbours(self, pos):
+        return self.indices[self.indptr[pos]:self.indptr[pos + 1]]
+
+    def neighbourFids(self, fid):
+        return self.fids[self.neighbours(self.position[fid])]
+
+
+def edgesToCsr(n, src, dst):
+
+    # turn an undirected edge list into symmetric CSR arrays sorted by neighbour
+    src = np.asarray(src, dtype = np.int64)
+    dst = np.asarray(dst, dtype = np.int64)
+    allSrc = np.concatenate([src, dst])
+    allDst = np.concatenate([dst, src])
+    order = np.lexsort((allDst, allSrc))
+    allSrc = allSrc[order]
+    allDst = allDst[order]
+    indptr = np.zeros(n + 1, dtype = np.int64)
+    np.cumsum(np.bincount(allSrc, minlength = n), out = indptr[1:])
+    return indptr, allDst
+
+
+def buildAdjacencyGraph(layer, monitor = None):
+
+    """
+    Derives the 'touches' relation of all features of a layer in one pass
+    """
+
+    # load geometries once and index their bounding boxes
+    request = QgsFeatureRequest().setNoAttributes()
+    fids = []
+    geoms = []
+    index = QgsSpatialIndex()
+    for feat in layer.getFeatures(request):
+        fids.append(feat.id())
+        geoms.append(QgsGeometry(feat.geometry()))
+        index.addFeature(feat)
+    position = {fid: i for i, fid in enumerate(fids)}
+
+    # test each candidate pair only once using prepared geometries
+    src = []
+    dst = []
+    n_feats = len(fids)
+    for i in list(range(0, n_feats)):
+
+        if monitor is not None:
+            monitor.progress(i, n_feats)
+
+        geom = geoms[i]
+        if geom.isEmpty():
+            continue
+        engine = QgsGeometry.createGeometryEngine(geom.constGet())
+        engine.prepareGeometry()
+        for cand in index.intersects(geom.boundingBox()):
+            j = position[cand]
+            if j <= i:
+                continue
+            if engine.touches(geoms[j].constGet()):
+                src.append(i)
+                dst.append(j)
+
+    indptr, indices = edgesToCsr(n_feats, src, dst)
+    return AdjacencyGraph(fids, indptr, indices)
+
+
+def graphToArray(graph):
+
+    # pack the graph into one int64 array: n, nnz, fids, indptr, indices
+    header = np.array([len(graph.fids), len(graph.indices)], dtype = np.int64)
+    return np.concatenate([header, graph.fids, graph.indptr, graph.indices])
+
+
+def graphFromArray(array):
+    n_feats = int(array[0])
+    nnz = int(array[1])
+    fids = array[2:2 + n_feats]
+    indptr = array[2 + n_feats:3 + 2 * n_feats]
+    indices = array[3 + 2 * n_feats:3 + 2 * n_feats + nnz]
+    return AdjacencyGraph(fids, indptr, indices)
+
+
+def cachedAdjacencyGraph(layer, sourceLayer, monitor = None):
+
+    """
+    Loads the adjacency graph from the sidecar cache of sourceLayer or builds it
+
+    The cache key is the fingerprint of the geometries and CRS of layer, so a
+    graph is only reused while the geometries stay the same.
+    """
+
+    stem = sidecarStem(sourceLayer)
+    key = layerFingerprint(layer, 'touches')
+    cached = loadCachedArray(stem, 'adjacency', key)
+    if cached is not None:
+        return graphFromArray(cached)
+
+    graph = buildAdjacencyGraph(layer, monitor)
+    storeCachedArray(stem, 'adjacency', key, graphToArray(graph))
+    return graph
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""
+Array based areal weighting behind shiftShapes.
+
+The overlay of source and target polygons is held as a sparse list of
+(source, target, intersection area) triples, positions referring to the fid
+arrays of both layers. The value transferred to a target is the sum of the
+source values weighted by the share of the target area they cover:
+
+    value[t] = sum over s of area(s, t) / area(t) * value[s]
+
+Since the overlay only depends on the geometries, it can be cached and reused
+for any number of attribute columns, turning a run into one sparse
+matrix-vector product per column. The module does not depend on QGIS.
+"""
+
+import numpy as np
+import os
+
+
+# bump whenever the layout of stored run states changes
+STATE_VERSION = 1
+
+
+class ArealOverlay(object):
+
+    """
+    Sparse intersection areas of source and target polygons
+    """
+
+    def __init__(self, srcFids, tgtFids, src, tgt, area, targetArea):
+        self.srcFids = np.asarray(srcFids, dtype = np.int64)
+        self.tgtFids = np.asarray(tgtFids, dtype = np.int64)
+        self.src = np.asarray(src, dtype = np.int64)
+        self.tgt = np.asarray(tgt, dtype = np.int64)
+        self.area = np.asarray(area, dtype = np.float64)
+        self.targetArea = np.asarray(targetArea, dtype = np.float64)
+
+    def __len__(self):
+        return len(self.area)
+
+    def weights(self):
+
+        """
+        Returns the weight of every pair, the covered share of the target area
+        """
+
+        targetArea = self.targetArea[self.tgt]
+        weights = np.zeros(len(self.area))
+        np.divide(self.area, targetArea, out = weights, where = targetArea > 0)
+        return weights
+
+
+class TileGrid(object):
+
+    """
+    Regular grid of square tiles over an extent, tiles numbered row by row
+
+    A feature belongs to every tile its bounding box overlaps. A source and
+    target pair is owned by exactly one tile, the one containing the lower
+    left corner of the intersection of their bounding boxes. That tile always
+    holds both features, so every pair is measured once although features
+    crossing tile borders are shipped to several tiles.
+    """
+
+    def __init__(self, xmin, ymin, xmax, ymax, tileSize):
+        self.x0 = float(xmin)
+        self.y0 = float(ymin)
+        self.size = float(tileSize)
+        self.nx = max(1, int(np.ceil((xmax - xmin) / self.size)))
+        self.ny = max(1, int(np.ceil((ymax - ymin) / self.size)))
+
+    def __len__(self):
+        return self.nx * self.ny
+
+    def columnRow(self, x, y):
+        ix = np.clip(np.floor((np.asarray(x, dtype = np.float64) - self.x0) / self.size), 0, self.nx - 1).astype(np.int64)
+        iy = np.clip(np.floor((np.asarray(y, dtype = np.float64) - self.y0) / self.size), 0, self.ny - 1).astype(np.int64)
+        return ix, iy
+
+    def tileOf(self, x, y):
+        ix, iy = self.columnRow(x, y)
+        return iy * self.nx + ix
+
+    def assign(self, bounds):
+
+        """
+        Returns a dict of tile -> positions of the (xmin, ymin, xmax, ymax) bounds overlapping it
+
+        Rows with NaN bounds (empty geometries) are left out.
+        """
+
+        bounds = np.asarray(bounds, dtype = np.float64).reshape(-1, 4)
+        valid = np.flatnonzero(~np.isnan(bounds).any(axis = 1))
+        ix0, iy0 = self.columnRow(bounds[valid, 0], bounds[valid, 1])
+        ix1, iy1 = self.columnRow(bounds[valid, 2], bounds[valid, 3])
+        tiles = {}
+        for k, pos in enumerate(valid.tolist()):
+            for iy in list(range(iy0[k], iy1[k] + 1)):
+                for ix in list(range(ix0[k], ix1[k] + 1)):
+                    tiles.setdefault(iy * self.nx + ix, []).append(pos)
+        return {tile: np.array(members, dtype = np.int64) for tile, members in tiles.items()}
+
+    def owner(self, boundsA, boundsB):
+
+        # tile owning a pair, from the lower left corner of the bounding box intersection
+        return self.tileOf(max(boundsA[0], boundsB[0]), max(boundsA[1], boundsB[1]))
+
+
+def mergePairs(parts):
+
+    """
+    Concatenates (src, tgt, area) parts and orders them by target and source
+    """
+
+    if not parts:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+    src = np.concatenate([p[0] for p in parts])
+    tgt = np.concatenate([p[1] for p in parts])
+    area = np.concatenate([p[2] for p in parts])
+    order = np.lexsort((src, tgt))
+    return src[order], tgt[order], area[order]
+
+
+def matchFeatures(oldFids, oldHashes, newFids, newHashes):
+
+    """
+    Matches the features of two runs by fid and per feature hash
+
+    Returns for every old position the new position of the same unchanged
+    feature (-1 if it was deleted or changed) and a boolean array flagging
+    the new positions holding new or changed features.
+    """
+
+    oldFids = np.asarray(oldFids, dtype = np.int64)
+    newFids = np.asarray(newFids, dtype = np.int64)
+    oldPos = np.full(len(newFids), -1, dtype = np.int64)
+    if len(oldFids):
+        order = np.argsort(oldFids, kind = 'stable')
+        idx = np.clip(np.searchsorted(oldFids[order], newFids), 0, len(oldFids) - 1)
+        found = oldFids[order][idx] == newFids
+        oldPos[found] = order[idx[found]]
+    same = oldPos >= 0
+    same[same] = np.asarray(oldHashes)[oldPos[same]] == np.asarray(newHashes)[same]
+    oldToNew = np.full(len(oldFids), -1, dtype = np.int64)
+    oldToNew[oldPos[same]] = np.flatnonzero(same)
+    return oldToNew, ~same
+
+
+def updatePairs(overlay, srcOldToNew, tgtOldToNew, parts):
+
+    """
+    Keeps the pairs of unchanged features of a previous overlay and adds new parts
+
+    Old positions are translated to the new ones; parts are (src, tgt, area)
+    triples in new positions covering every pair with a new or changed feature.
+    """
+
+    src = srcOldToNew[overlay.src]
+    tgt = tgtOldToNew[overlay.tgt]
+    keep = (src >= 0) & (tgt >= 0)
+    return mergePairs([(src[keep], tgt[keep], overlay.area[keep])] + list(parts))
+
+
+def changedValues(oldValues, newValues):
+
+    # flags columns of a (fields x features) array differing between runs, NaN equals NaN
+    same = (oldValues == newValues) | (np.isnan(oldValues) & np.isnan(newValues))
+    return ~same.all(axis = 0)
+
+
+def saveRunState(path, overlay, srcHashes, tgtHashes, outFids, values, columns, crs):
+
+    """
+    Stores everything an incremental run needs from the previous run
+    """
+
+    tempPath = path + '.tmp.npz'
+    np.savez_compressed(tempPath, version = np.array([STATE_VERSION]), overlay = overlayToArray(overlay),
+                        srcHashes = np.asarray(srcHashes, dtype = np.uint64),
+                        tgtHashes = np.asarray(tgtHashes, dtype = np.uint64),
+                        outFids = np.asarray(outFids, dtype = np.int64), values = values,
+                        columns = np.array([str(c) for c in columns]), crs = np.array([crs]))
+    os.replace(tempPath, path)
+    return path
+
+
+def loadRunState(path):
+
+    """
+    Loads a stored run state, returns None if missing or unreadable
+    """
+
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as stored:
+            if int(stored['version'][0]) != STATE_VERSION:
+                return None
+            state = {k: stored[k] for k in stored.files}
+    except (OSError, ValueError, KeyError):
+        return None
+    state['overlay'] = overlayFromArray(state['overlay'])
+    state['columns'] = [str(c) for c in state['columns']]
+    state['crs'] = str(state['crs'][0])
+    return state
+
+
+def labelCellCounts(labels, n_labels, chunkRows = 1024):
+
+    """
+    Counts the cells of every label 1..n_labels of a (memory-mapped) label grid
+
+    Returns an array indexed by position (label - 1).
+    """
+
+    counts = np.zeros(n_labels + 1, dtype = np.int64)
+    for r in list(range(0, labels.shape[0], chunkRows)):
+        counts += np.bincount(np.asarray(labels[r:r + chunkRows]).ravel(), minlength = n_labels + 1)[:n_labels + 1]
+    return counts[1:]
+
+
+def labelPairCounts(srcLabels, tgtLabels, n_tgt, chunkRows = 1024):
+
+    """
+    Counts the cells shared by every source and target label pair of two grids
+
+    Both grids hold position + 1 per cell and 0 where no polygon lies. They are
+    processed in row chunks, so memory-mapped grids never have to be loaded
+    completely. Returns source positions, target positions and cell counts.
+    """
+
+    codes = []
+    counts = []
+    for r in list(range(0, srcLabels.shape[0], chunkRows)):
+        s = np.asarray(srcLabels[r:r + chunkRows]).ravel()
+        t = np.asarray(tgtLabels[r:r + chunkRows]).ravel()
+        valid = (s > 0) & (t > 0)
+        code, count = np.unique((s[valid].astype(np.int64) - 1) * n_tgt + (t[valid].astype(np.int64) - 1),
+                                return_counts = True)
+        codes.append(code)
+        counts.append(count)
+    if not codes:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    code, inverse = np.unique(np.concatenate(codes), return_inverse = True)
+    count = np.bincount(inverse, weights = np.concatenate(counts)).astype(np.int64)
+    return code // n_tgt, code % n_tgt, count
+
+
+def areaErrors(exactArea, approxArea):
+
+    """
+    Summarises the relative error of approximated against exact polygon areas
+    """
+
+    exactArea = np.asarray(exactArea, dtype = np.float64)
+    approxArea = np.asarray(approxArea, dtype = np.float64)
+    valid = exactArea > 0
+    relative = np.abs(approxArea[valid] - exactArea[valid]) / exactArea[valid]
+    return {'features': int(len(exactArea)),
+            'missed': int(np.sum(valid & (approxArea == 0))),
+            'totalExactArea': float(exactArea.sum()),
+            'totalApproxArea': float(approxArea.sum()),
+            'meanRelativeError': float(relative.mean()) if len(relative) else 0.0,
+            'maxRelativeError': float(relative.max()) if len(relative) else 0.0}
+
+
+def aggregateWeighted(values, src, tgt, weights, n_targets):
+
+    """
+    Sums weighted source values per target for all rows of a (fields x sources) array
+
+    NaN source values are skipped; targets without any valid contribution get NaN.
+    """
+
+    values = np.array(values, dtype = np.float64, ndmin = 2)
+    result = np.full((values.shape[0], n_targets), np.nan)
+    for v in list(range(0, values.shape[0])):
+        contrib = values[v, src]
+        valid = ~np.isnan(contrib)
+        sums = np.bincount(tgt[valid], weights = weights[valid] * contrib[valid], minlength = n_targets)
+        hit = np.bincount(tgt[valid], minlength = n_targets) > 0
+        result[v, hit] = sums[hit]
+    return result
+
+
+def overlayToArray(overlay):
+
+    # pack the overlay into one int64 array, areas are stored bitwise:
+    # n_src, n_tgt, nnz, srcFids, tgtFids, src, tgt, area, targetArea
+    header = np.array([len(overlay.srcFids), len(overlay.tgtFids), len(overlay.area)], dtype = np.int64)
+    return np.concatenate([header, overlay.srcFids, overlay.tgtFids, overlay.src, overlay.tgt,
+                           overlay.area.view(np.int64), overlay.targetArea.view(np.int64)])
+
+
+def overlayFromArray(array):
+    n_src, n_tgt, nnz = [int(n) for n in array[:3]]
+    bounds = np.cumsum([3, n_src, n_tgt, nnz, nnz, nnz, n_tgt])
+    parts = [array[bounds[k]:bounds[k + 1]] for k in list(range(0, len(bounds) - 1))]
+    srcFids, tgtFids, src, tgt, area, targetArea = parts
+    return ArealOverlay(srcFids, tgtFids, src, tgt, np.asarray(area).view(np.float64),
+                        np.asarray(targetArea).view(np.float64))
+
+
+def saveWeightMatrix(path, overlay):
+
+    """
+    Writes the source-to-target weights as compressed COO arrays keyed by fid
+    """
+
+    np.savez_compressed(path, source = overlay.srcFids[overlay.src], target = overlay.tgtFids[overlay.tgt],
+                        weight = overlay.weights(), shape = np.array([len(overlay.srcFids), len(overlay.tgtFids)]))
+    return path
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+Polygon overlay used by shiftShapes.
+
+Instead of a full union of both layers only the intersection areas of source
+and target pairs are computed: the sources are indexed once, every target
+queries the index for candidates and measures the intersections with a
+prepared geometry engine. All areas are measured in the CRS of the targets.
+
+For large layers the extent can be split into a grid of tiles, which are
+measured in a process pool and merged without counting any pair twice (see
+arealEngine.TileGrid). The overlay can be cached next to the source layer,
+keyed by the fingerprints of both geometry sets including their CRS.
+"""
+
+from qgis.core import (QgsCoordinateTransform,
+                       QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsProject,
+                       QgsSpatialIndex)
+from collections import deque
+import hashlib
+import numpy as np
+
+from arealEngine import (ArealOverlay,
+                         TileGrid,
+                         mergePairs,
+                         overlayFromArray,
+                         overlayToArray)
+from geometryCache import (layerFingerprint,
+                           loadCachedArray,
+                           sidecarStem,
+                           storeCachedArray)
+from processPool import (createProcessPool,
+                         resolveProcesses)
+
+
+def loadGeometries(layer, crs = None):
+
+    """
+    Returns fids and geometries of a layer, optionally transformed to crs
+    """
+
+    transform = None
+    if crs is not None and layer.crs() != crs:
+        transform = QgsCoordinateTransform(layer.crs(), crs, QgsProject.instance())
+    fids = []
+    geoms = []
+    for feat in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        geom = QgsGeometry(feat.geometry())
+        if transform is not None and not geom.isEmpty():
+            geom.transform(transform)
+        fids.append(feat.id())
+        geoms.append(geom)
+    return np.array(fids, dtype = np.int64), geoms
+
+
+def geometryBounds(geoms):
+
+    # (xmin, ymin, xmax, ymax) per geometry, NaN for empty ones
+    bounds = np.full((len(geoms), 4), np.nan)
+    for i, geom in enumerate(geoms):
+        if not geom.isEmpty():
+            box = geom.boundingBox()
+            bounds[i] = (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum())
+    return bounds
+
+
+def intersectionAreas(srcGeoms, tgtGeoms, monitor = None, owner = None):
+
+    """
+    Measures all non-empty intersections of source and target geometries
+
+    With owner = (grid, tile, srcBounds, tgtBounds) only the pairs owned by
+    that tile are measured. Returns source positions, target positions and
+    intersection areas.
+    """
+
+    index = QgsSpatialIndex()
+    for i, geom in enumerate(srcGeoms):
+        if not geom.isEmpty():
+            index.addFeature(i, geom.boundingBox())
+
+    src = []
+    tgt = []
+    area = []
+    for j, geom in enumerate(tgtGeoms):
+
+        if monitor is not None:
+            monitor.progress(j, len(tgtGeoms))
+
+        if geom.isEmpty():
+            continue
+        engine = QgsGeometry.createGeometryEngine(geom.constGet())
+        engine.prepareGeometry()
+        for i in index.intersects(geom.boundingBox()):
+            if owner is not None:
+                grid, tile, srcBounds, tgtBounds = owner
+                if grid.owner(srcBounds[i], tgtBounds[j]) != tile:
+                    continue
+            other = srcGeoms[i].constGet()
+            if not engine.intersects(other):
+                continue
+            inter = engine.intersection(other)
+            if inter is None:
+                continue
+            a = inter.area()
+            if a > 0:
+                src.append(i)
+                tgt.append(j)
+                area.append(a)
+    return (np.array(src, dtype = np.int64), np.array(tgt, dtype = np.int64),
+            np.array(area, dtype = np.float64))
+
+
+def geometryFromWkb(wkb):
+    geom = QgsGeometry()
+    geom.fromWkb(wkb)
+    return geom
+
+
+def overlayTile(unit):
+
+    """
+    Process pool entry point measuring the pairs owned by one tile
+    """
+
+    grid, tile, srcPos, srcBounds, srcWkb, tgtPos, tgtBounds, tgtWkb = unit
+    srcGeoms = [geometryFromWkb(w) for w in srcWkb]
+    tgtGeoms = [geometryFromWkb(w) for w in tgtWkb]
+    src, tgt, area = intersectionAreas(srcGeoms, tgtGeoms, owner = (grid, tile, srcBounds, tgtBounds))
+    return srcPos[src], tgtPos[tgt], area
+
+
+def tiledIntersectionAreas(srcGeoms, tgtGeoms, tileSize, processes = 0, monitor = None):
+
+    """
+    Same as intersectionAreas, computed tile by tile in a process pool
+    """
+
+    srcBounds = geometryBounds(srcGeoms)
+    tgtBounds = geometryBounds(tgtGeoms)
+    allBounds = np.vstack([srcBounds, tgtBounds])
+    if np.isnan(allBounds).all():
+        return mergePairs([])
+    grid = TileGrid(np.nanmin(allBounds[:, 0]), np.nanmin(allBounds[:, 1]),
+                    np.nanmax(allBounds[:, 2]), np.nanmax(allBounds[:, 3]), tileSize)
+    srcTiles = grid.assign(srcBounds)
+    tgtTiles = grid.assign(tgtBounds)
+
+    # ship geometries as WKB, a feature crossing tile borders goes to every tile it overlaps
+    def units():
+        for tile in sorted(set(srcTiles) & set(tgtTiles)):
+            s = srcTiles[tile]
+            t = tgtTiles[tile]
+            yield (grid, tile, s, srcBounds[s], [bytes(srcGeoms[i].asWkb()) for i in s.tolist()],
+                   t, tgtBounds[t], [bytes(tgtGeoms[j].asWkb()) for j in t.tolist()])
+    n_units = len(set(srcTiles) & set(tgtTiles))
+
+    parts = []
+    processes = resolveProcesses(processes)
+    if processes == 1:
+        for unit in units():
+            parts.append(overlayTile(unit))
+            if monitor is not None:
+                monitor.progress(len(parts), n_units)
+    else:
+        # keep only a few tiles per worker in flight to bound memory
+        with createProcessPool(processes) as pool:
+            pending = deque()
+            for unit in units():
+                pending.append(pool.submit(overlayTile, unit))
+                if len(pending) >= 4 * processes:
+                    parts.append(pending.popleft().result())
+                    if monitor is not None:
+                        monitor.progress(len(parts), n_units)
+            while pending:
+                parts.append(pending.popleft().result())
+                if monitor is not None:
+                    monitor.progress(len(parts), n_units)
+    return mergePairs(parts)
+
+
+def buildOverlay(sourceLayer, targetLayer, monitor = None, tileSize = 0, processes = 1, prep = None):
+
+    """
+    Derives the intersection areas of all source and target features
+
+    A positive tileSize (in target CRS units) switches to the tiled overlay
+    spread over the given number of processes (0 means all cores). An optional
+    GeometryPrep cleans the geometries first and filters the fragments.
+    """
+
+    tgtFids, tgtGeoms = loadGeometries(targetLayer)
+    srcFids, srcGeoms = loadGeometries(sourceLayer, targetLayer.crs())
+    if prep is not None:
+        tgtGeoms = prep.apply(tgtGeoms, 'targets')
+        srcGeoms = prep.apply(srcGeoms, 'sources')
+    if tileSize > 0:
+        src, tgt, area = tiledIntersectionAreas(srcGeoms, tgtGeoms, tileSize, processes, monitor)
+    else:
+        src, tgt, area = intersectionAreas(srcGeoms, tgtGeoms, monitor)
+    if prep is not None:
+        src, tgt, area = prep.filterPairs(src, tgt, area)
+    targetArea = np.array([g.area() for g in tgtGeoms], dtype = np.float64)
+    return ArealOverlay(srcFids, tgtFids, src, tgt, area, targetArea)
+
+
+def overlayKey(sourceLayer, targetLayer, prepKey = ''):
+
+    # both fingerprints cover fids, geometries and CRS of their layer
+    digest = hashlib.sha1()
+    digest.update(layerFingerprint(sourceLayer, 'overlay source', prepKey).encode('utf-8'))
+    digest.update(layerFingerprint(targetLayer, 'overlay target').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def overlayTag(targetLayer):
+
+    # one cache entry per target: a short hash of the target's data source and
+    # layer, so storing the weights for one target never evicts those of another
+    identity = sidecarStem(targetLayer) or targetLayer.source()
+    return 'weights_' + hashlib.sha1(identity.encode('utf-8')).hexdigest()[:12]
+
+
+def cachedOverlay(sourceLayer, targetLayer, monitor = None, tileSize = 0, processes = 1, prep = None):
+
+    """
+    Loads the overlay from the sidecar cache of the source layer or builds it
+
+    Every target layer gets its own entry, so one source can keep the weights
+    for several targets. Returns the overlay and whether it came from the cache.
+    """
+
+    stem = sidecarStem(sourceLayer)
+    key = overlayKey(sourceLayer, targetLayer, prep.key() if prep is not None else '') if stem is not None else None
+    tag = overlayTag(targetLayer)
+    cached = loadCachedArray(stem, tag, key)
+    if cached is not None:
+        return overlayFromArray(cached), True
+
+    overlay = buildOverlay(sourceLayer, targetLayer, monitor, tileSize, processes, prep)
+    storeCachedArray(stem, tag, key, overlayToArray(overlay))
+    return overlay, False
+
+
+def loadValues(layer, fieldIdx, fids, monitor = None):
+
+    """
+    Loads numeric attribute values into a (fields x features) array ordered like fids
+
+    NULL and non-numeric values become NaN.
+    """
+
+    position = {int(fid): i for i, fid in enumerate(fids)}
+    values = np.full((len(fieldIdx), len(fids)), np.nan)
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(fieldIdx)
+    for n, feat in enumerate(layer.getFeatures(request)):
+        pos = position.get(feat.id())
+        if pos is None:
+            continue
+        for v in list(range(0, len(fieldIdx))):
+            try:
+                values[v, pos] = float(feat[fieldIdx[v]])
+            except (TypeError, ValueError):
+                pass
+        if monitor is not None:
+            monitor.progress(n, len(fids))
+    return values
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+Approximate raster overlay used by shiftShapes.
+
+Source and target polygons are burnt into two label grids with a common
+origin and cell size (label = position + 1, 0 = no polygon). The grids are
+rasterized strip by strip with GDAL into memory-mapped files, so their size is
+only limited by disk space. A cell belongs to the polygon containing its
+centre, and the intersection area of a pair is approximated by the number of
+cells carrying both labels times the cell area. The cost is nearly constant per
+cell, independent of the complexity of the polygons.
+"""
+
+import numpy as np
+import os
+import shutil
+import tempfile
+
+try:
+    from osgeo import gdal, ogr
+except ImportError:
+    gdal = None
+
+from arealEngine import (ArealOverlay,
+                         areaErrors,
+                         labelCellCounts,
+                         labelPairCounts)
+from arealOverlay import (geometryBounds,
+                          loadGeometries)
+
+
+# rows per rasterized strip are chosen to hold about this many cells
+STRIP_CELLS = 4000000
+
+
+def labelLayer(geoms):
+
+    # in-memory OGR layer holding the geometries with their label
+    driver = ogr.GetDriverByName('Memory') or ogr.GetDriverByName('MEM')
+    ds = driver.CreateDataSource('labels')
+    layer = ds.CreateLayer('labels', geom_type = ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger64))
+    definition = layer.GetLayerDefn()
+    for i, geom in enumerate(geoms):
+        if geom.isEmpty():
+            continue
+        feat = ogr.Feature(definition)
+        feat.SetField('label', i + 1)
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+        layer.CreateFeature(feat)
+    return ds, layer
+
+
+def rasterizeLabels(geoms, path, x0, y1, cellSize, n_cols, n_rows, monitor = None, done = 0, total = 1):
+
+    """
+    Burns position + 1 of every geometry into a memory-mapped int32 grid
+    """
+
+    labels = np.lib.format.open_memmap(path, mode = 'w+', dtype = np.int32, shape = (n_rows, n_cols))
+    ds, layer = labelLayer(geoms)
+    stripRows = max(1, STRIP_CELLS // max(1, n_cols))
+    driver = gdal.GetDriverByName('MEM')
+    for r in list(range(0, n_rows, stripRows)):
+        rows = min(stripRows, n_rows - r)
+        top = y1 - r * cellSize
+        strip = driver.Create('', n_cols, rows, 1, gdal.GDT_Int32)
+        strip.SetGeoTransform((x0, cellSize, 0.0, top, 0.0, -cellSize))
+        layer.SetSpatialFilterRect(x0, top - rows * cellSize, x0 + n_cols * cellSize, top)
+        gdal.RasterizeLayer(strip, [1], layer, options = ['ATTRIBUTE=label'])
+        labels[r:r + rows] = strip.GetRasterBand(1).ReadAsArray()
+        strip = None
+        if monitor is not None:
+            monitor.progress(done + r + rows, total)
+    labels.flush()
+    layer = None
+    ds = None
+    return labels
+
+
+def rasterOverlay(sourceLayer, targetLayer, cellSize, monitor = None, prep = None):
+
+    """
+    Approximates the overlay of both layers on a grid of the given cell size
+
+    Areas are taken from the grid for pairs and targets alike, so the weights
+    of a fully covered target still sum up to one. Returns the overlay and a
+    report comparing the rasterized with the exact polygon areas.
+    """
+
+    if gdal is None:
+        raise RuntimeError('The raster overlay requires the GDAL Python bindings')
+
+    tgtFids, tgtGeoms = loadGeometries(targetLayer)
+    srcFids, srcGeoms = loadGeometries(sourceLayer, targetLayer.crs())
+    if prep is not None:
+        tgtGeoms = prep.apply(tgtGeoms, 'targets')
+        srcGeoms = prep.apply(srcGeoms, 'sources')
+    bounds = np.vstack([geometryBounds(srcGeoms), geometryBounds(tgtGeoms)])
+    if np.isnan(bounds).all():
+        overlay = ArealOverlay(srcFids, tgtFids, [], [], [], np.zeros(len(tgtFids)))
+        return overlay, {}
+
+    # common grid covering both layers
+    x0 = np.nanmin(bounds[:, 0])
+    y0 = np.nanmin(bounds[:, 1])
+    n_cols = max(1, int(np.ceil((np.nanmax(bounds[:, 2]) - x0) / cellSize)))
+    n_rows = max(1, int(np.ceil((np.nanmax(bounds[:, 3]) - y0) / cellSize)))
+    y1 = y0 + n_rows * cellSize
+    cellArea = cellSize * cellSize
+
+    workDir = tempfile.mkdtemp(prefix = 'shiftShapes_')
+    try:
+        srcLabels = rasterizeLabels(srcGeoms, os.path.join(workDir, 'source.npy'), x0, y1, cellSize, n_cols, n_rows,
+                                    monitor, 0, 2 * n_rows)
+        tgtLabels = rasterizeLabels(tgtGeoms, os.path.join(workDir, 'target.npy'), x0, y1, cellSize, n_cols, n_rows,
+                                    monitor, n_rows, 2 * n_rows)
+        src, tgt, cells = labelPairCounts(srcLabels, tgtLabels, len(tgtFids))
+        srcCells = labelCellCounts(srcLabels, len(srcFids))
+        tgtCells = labelCellCounts(tgtLabels, len(tgtFids))
+        del srcLabels, tgtLabels
+    finally:
+        shutil.rmtree(workDir, ignore_errors = True)
+    if prep is not None:
+        src, tgt, cells = prep.filterPairs(src, tgt, cells * cellArea)
+        cells = cells / cellArea
+
+    overlay = ArealOverlay(srcFids, tgtFids, src, tgt, cells * cellArea, tgtCells * cellArea)
+    report = {'cellSize': float(cellSize),
+              'grid': [n_rows, n_cols],
+              'sources': areaErrors([g.area() for g in srcGeoms], srcCells * cellArea),
+              'targets': areaErrors([g.area() for g in tgtGeoms], tgtCells * cellArea)}
+    return overlay, report
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless batch runner for the DataTools algorithms.
+
+Runs the jobs of a JSON manifest in a process pool without a display, canvas
+or project. QGIS and the processing framework are initialised once per worker
+process and then serve all jobs the worker receives.
+
+    python batchRunner.py nightly.json --processes 8 --report nightly_report.json
+
+A manifest holds a list of jobs and optional defaults merged into every job:
+
+    {"defaults": {"algorithm": "shiftShapes",
+                  "parameters": {"colApply": ["population"], "useCache": true}},
+     "jobs": [{"name": "district01_2024",
+               "inputs": {"inShape": "census/2024.gpkg", "outShape": "districts/01.gpkg"},
+               "outputs": {"output": "results/01_2024.gpkg"}}]}
+
+Inputs and outputs are file paths, relative ones are taken relative to the
+manifest; parameters are passed to the algorithm as they are. The run exits
+with status 1 if any job failed.
+"""
+
+from concurrent.futures import as_completed
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import traceback
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+if scriptDir not in sys.path:
+    sys.path.append(scriptDir)
+
+from processPool import (createProcessPool,
+                         resolveProcesses)
+
+
+# algorithms that can be run, each lives in the script of the same name
+ALGORITHMS = ['abideMinCases',
+              'binEncoder',
+              'encodingPipeline',
+              'oneHotEncoder',
+              'shiftShapes']
+
+# QGIS application and imported algorithm modules of this worker process
+_app = None
+_modules = {}
+
+
+def resolvePath(path, baseDir):
+    return path if os.path.isabs(path) else os.path.normpath(os.path.join(baseDir, path))
+
+
+def loadManifest(path):
+
+    """
+    Reads a manifest and returns its jobs with defaults merged and paths resolved
+    """
+
+    with open(path, encoding = 'utf-8') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    baseDir = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    outputs = {}
+    for i, entry in enumerate(manifest.get('jobs', [])):
+        job = {'algorithm': entry.get('algorithm', defaults.get('algorithm'))}
+        if job['algorithm'] not in ALGORITHMS:
+            raise ValueError('Job %d: unknown algorithm %r, expected one of %s' % (i, job['algorithm'], ', '.join(ALGORITHMS)))
+        job['name'] = str(entry.get('name', '%s_%d' % (job['algorithm'], i)))
+        for key in ('inputs', 'parameters', 'outputs'):
+            job[key] = dict(defaults.get(key, {}))
+            job[key].update(entry.get(key, {}))
+        job['inputs'] = {param: resolvePath(p, baseDir) for param, p in job['inputs'].items()}
+        job['outputs'] = {param: resolvePath(p, baseDir) for param, p in job['outputs'].items()}
+
+        # parallel jobs must never write the same file
+        for p in job['outputs'].values():
+            if p in outputs:
+                raise ValueError('Jobs %s and %s both write %s' % (outputs[p], job['name'], p))
+            outputs[p] = job['name']
+        jobs.append(job)
+    return jobs
+
+
+def startQgis():
+
+    # initialise QGIS and the processing framework on an offscreen display
+    global _app
+    if _app is not None:
+        return _app
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qgis.core import QgsApplication
+    _app = QgsApplication([], False)
+    _app.initQgis()
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    if QgsApplication.processingRegistry().providerById('native') is None:
+        from qgis.analysis import QgsNativeAlgorithms
+        QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+    return _app
+
+
+def createAlgorithm(name):
+
+    # import an algorithm script once per process, the way the QGIS script provider does
+    if name not in _modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(scriptDir, name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[name] = module
+    return getattr(_modules[name], name)().create()
+
+
+def plainValue(value):
+
+    # JSON compatible form of an algorithm result
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [plainValue(v) for v in value]
+    return str(value)
+
+
+def runJob(job):
+
+    """
+    Runs one job in this process and returns its outcome
+    """
+
+    startQgis()
+    from qgis.core import (QgsProcessingContext,
+                           QgsProcessingFeedback)
+
+    class JobFeedback(QgsProcessingFeedback):
+
+        # keeps the error messages of the algorithm for the report
+        def __init__(self):
+            super().__init__()
+            self.errors = []
+
+        def reportError(self, error, fatalError = False):
+            self.errors.append(error)
+
+    result = {'name': job['name'], 'algorithm': job['algorithm'], 'ok': False}
+    start = time.perf_counter()
+    try:
+        for p in job['outputs'].values():
+            os.makedirs(os.path.dirname(p) or '.', exist_ok = True)
+        parameters = dict(job['parameters'])
+        parameters.update(job['inputs'])
+        parameters.update(job['outputs'])
+        alg = createAlgorithm(job['algorithm'])
+        context = QgsProcessingContext()
+        feedback = JobFeedback()
+        outputs, ok = alg.run(parameters, context, feedback)
+        result['ok'] = bool(ok)
+        result['outputs'] = {k: plainValue(v) for k, v in (outputs or {}).items()}
+        if feedback.errors:
+            result['error'] = '\n'.join(feedback.errors)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def runJobs(jobs, processes = 0, log = print):
+
+    """
+    Runs all jobs, in this process for a single worker, else in a process pool
+
+    Returns the outcomes in manifest order.
+    """
+
+    results = [None] * len(jobs)
+
+    def finished(i, result):
+        results[i] = result
+        done = sum(r is not None for r in results)
+        log('[%d/%d] %-6s %-40s %9.1f s' % (done, len(jobs), 'ok' if result['ok'] else 'FAILED', result['name'],
+                                           result.get('seconds', 0.0)))
+
+    if resolveProcesses(processes) == 1:
+        for i, job in enumerate(jobs):
+            finished(i, runJob(job))
+        return results
+
+    with createProcessPool(min(resolveProcesses(processes), max(1, len(jobs))), startQgis) as pool:
+        futures = {pool.submit(runJob, job): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # a crashed worker takes its job down, the pool reports the others
+                result = {'name': jobs[i]['name'], 'algorithm': jobs[i]['algorithm'], 'ok': False,
+                          'error': repr(e)}
+            finished(i, result)
+    return results
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run a manifest of DataTools jobs without a QGIS session.')
+    parser.add_argument('manifest', help = 'JSON file listing the jobs')
+    parser.add_argument('--processes', type = int, default = 0,
+                        help = 'number of worker processes (0 = all cores, 1 = run in this process)')
+    parser.add_argument('--jobs', help = 'comma separated job names to run, default all')
+    parser.add_argument('--report', help = 'write the outcome of every job to this JSON file')
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = loadManifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.jobs:
+        selected = set(n.strip() for n in args.jobs.split(',') if n.strip())
+        unknown = selected - set(job['name'] for job in jobs)
+        if unknown:
+            parser.error('unknown jobs ' + ', '.join(sorted(unknown)))
+        jobs = [job for job in jobs if job['name'] in selected]
+
+    started = time.perf_counter()
+    results = runJobs(jobs, args.processes)
+    failed = [r for r in results if not r['ok']]
+    for r in failed:
+        print('FAILED %s: %s' % (r['name'], (r.get('error') or 'no error message').strip().splitlines()[-1]))
+    print('%d jobs, %d failed, %.1f s' % (len(results), len(failed), time.perf_counter() - started))
+
+    if args.report:
+        with open(args.report, 'w', encoding = 'utf-8') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'manifest': os.path.abspath(args.manifest),
+                       'results': results}, f, indent = 2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless benchmark harness for the DataTools algorithms.
+
+Every case runs one algorithm on a synthetic input of a given size in a fresh
+Python process, so wall time and peak memory are not influenced by earlier
+cases. Results are compared against a JSON baseline file and regressions beyond
+the tolerance make the run exit with status 1.
+
+    python benchmarks/runBenchmarks.py --sizes 1000,10000,100000
+    python benchmarks/runBenchmarks.py --sizes 1000 --update-baseline
+
+Only the QGIS Python bindings and the processing plugin are required; Qt runs
+on the offscreen platform, so no display is needed.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchDir)
+
+
+# algorithm script, input parameters and synthetic inputs of every case
+CASES = {
+    'abideMinCases/regularGrid': {
+        'script': 'abideMinCases.py',
+        'inputs': {'inputTab': 'regularGrid'},
+        'parameters': {'colApply': ['count_0', 'count_1', 'count_2'], 'thresh': '5', 'maxIter': '3',
+                       'useCache': False},
+        'output': ('output', '.gpkg'),
+    },
+    'abideMinCases/irregularGrid': {
+        'script': 'abideMinCases.py',
+        'inputs': {'inputTab': 'irregularGrid'},
+        'parameters': {'colApply': ['count_0', 'count_1', 'count_2'], 'thresh': '5', 'maxIter': '3',
+                       'useCache': False},
+        'output': ('output', '.gpkg'),
+    },
+    'shiftShapes/irregularGrid': {
+        'script': 'shiftShapes.py',
+        'inputs': {'inShape': 'irregularGrid', 'outShape': 'coarseIrregularGrid'},
+        'parameters': {'colApply': ['count_0', 'count_1', 'count_2'], 'useCache': False},
+        'output': ('output', '.gpkg'),
+    },
+    'shiftShapes/irregularGrid/tiled': {
+        'script': 'shiftShapes.py',
+        'inputs': {'inShape': 'irregularGrid', 'outShape': 'coarseIrregularGrid'},
+        'parameters': {'colApply': ['count_0', 'count_1', 'count_2'], 'useCache': False, 'tileSize': 2000,
+                       'processes': 0},
+        'output': ('output', '.gpkg'),
+    },
+    'shiftShapes/irregularGrid/raster': {
+        'script': 'shiftShapes.py',
+        'inputs': {'inShape': 'irregularGrid', 'outShape': 'coarseIrregularGrid'},
+        'parameters': {'colApply': ['count_0', 'count_1', 'count_2'], 'useCache': False, 'cellSize': 10},
+        'output': ('output', '.gpkg'),
+    },
+    'oneHotEncoder/wideTable': {
+        'script': 'oneHotEncoder.py',
+        'inputs': {'inputTab': 'wideTable'},
+        'parameters': {'colsEnc': ['cat_' + str(c) for c in range(0, 20)]},
+        'output': ('output', '.csv'),
+    },
+    'oneHotEncoder/highCardinalityTable': {
+        'script': 'oneHotEncoder.py',
+        'inputs': {'inputTab': 'highCardinalityTable'},
+        'parameters': {'colsEnc': ['cat_0']},
+        'output': ('output', '.csv'),
+    },
+    'oneHotEncoder/highCardinalityTable/sparse': {
+        'script': 'oneHotEncoder.py',
+        'inputs': {'inputTab': 'highCardinalityTable'},
+        'parameters': {'colsEnc': ['cat_0'], 'mode': 1},
+        'output': ('output', '.csv'),
+    },
+    'oneHotEncoder/highCardinalityTable/hashed': {
+        'script': 'oneHotEncoder.py',
+        'inputs': {'inputTab': 'highCardinalityTable'},
+        'parameters': {'colsEnc': ['cat_0'], 'mode': 2, 'buckets': 256, 'chunkSize': 50000},
+        'output': ('output', '.csv'),
+    },
+    'oneHotEncoder/wideTable/streaming': {
+        'script': 'oneHotEncoder.py',
+        'inputs': {'inputTab': 'wideTable'},
+        'parameters': {'colsEnc': ['cat_' + str(c) for c in range(0, 20)], 'chunkSize': 50000},
+        'output': ('output', '.csv'),
+    },
+    'binEncoder/wideTable': {
+        'script': 'binEncoder.py',
+        'inputs': {'inputTab': 'wideTable'},
+        'parameters': {'colEnc': ['num_0', 'num_1', 'num_2', 'num_3'], 'lw_bound': '0,10,20,30,40,50,60,70,80,90',
+                       'up_bound': '10,20,30,40,50,60,70,80,90,100'},
+        'output': ('output', '.csv'),
+    },
+    'binEncoder/wideTable/equalCount': {
+        'script': 'binEncoder.py',
+        'inputs': {'inputTab': 'wideTable'},
+        'parameters': {'colEnc': ['num_0', 'num_1', 'num_2', 'num_3'], 'method': 1, 'nBins': 10,
+                       'chunkSize': 50000},
+        'output': ('output', '.csv'),
+    },
+    'encodingPipeline/wideTable': {
+        'script': 'encodingPipeline.py',
+        'inputs': {'inputTab': 'wideTable'},
+        'parameters': {'specs': json.dumps([{'type': 'onehot', 'columns': ['cat_' + str(c) for c in range(0, 10)]},
+                                            {'type': 'bin', 'columns': ['num_0', 'num_1'], 'method': 'equal count',
+                                             'bins': 10},
+                                            {'type': 'hashed', 'columns': ['cat_10', 'cat_11'], 'buckets': 64}]),
+                       'chunkSize': 50000},
+        'output': ('output', '.csv'),
+    },
+}
+
+
+def startQgis():
+
+    # initialise QGIS and the processing framework on an offscreen display
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qgis.core import QgsApplication
+    app = QgsApplication([], True)
+    app.initQgis()
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    if QgsApplication.processingRegistry().providerById('native') is None:
+        from qgis.analysis import QgsNativeAlgorithms
+        QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+    return app
+
+
+def loadAlgorithm(script):
+
+    # import an algorithm script the way the QGIS script provider does
+    path = os.path.join(repoDir, script)
+    name = os.path.splitext(script)[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, name)().create()
+
+
+def prepareCase(caseName, n_feats, workDir):
+
+    # generate the inputs of a case without measuring anything
+    app = startQgis()
+    sys.path.insert(0, benchDir)
+    from syntheticData import syntheticInput
+    for kind in CASES[caseName]['inputs'].values():
+        syntheticInput(kind, n_feats, workDir)
+    app.exitQgis()
+    return {'case': caseName, 'features': n_feats, 'ok': True}
+
+
+def runCase(caseName, n_feats, workDir):
+
+    """
+    Runs one case in this process and returns its measurements
+    """
+
+    app = startQgis()
+    from qgis.core import (QgsProcessingContext,
+                           QgsProcessingFeedback)
+    sys.path.insert(0, benchDir)
+    sys.path.insert(0, repoDir)
+    from processingMonitor import peakMemoryMB
+    from syntheticData import syntheticInput
+
+    case = CASES[caseName]
+    parameters = dict(case['parameters'])
+    for param, kind in case['inputs'].items():
+        parameters[param] = syntheticInput(kind, n_feats, workDir)
+    outDir = tempfile.mkdtemp(dir = workDir)
+    outParam, outExt = case['output']
+    parameters[outParam] = os.path.join(outDir, 'output' + outExt)
+    parameters['stageReport'] = os.path.join(outDir, 'stages.json')
+
+    alg = loadAlgorithm(case['script'])
+    context = QgsProcessingContext()
+    feedback = QgsProcessingFeedback()
+    start = time.perf_counter()
+    results, ok = alg.run(parameters, context, feedback)
+    seconds = time.perf_counter() - start
+
+    stages = []
+    if os.path.isfile(parameters['stageReport']):
+        with open(parameters['stageReport'], encoding = 'utf-8') as f:
+            stages = json.load(f).get('stages', [])
+
+    app.exitQgis()
+    return {'case': caseName,
+            'features': n_feats,
+            'ok': bool(ok),
+            'seconds': round(seconds, 6),
+            'peakMemoryMB': peakMemoryMB(),
+            'stages': stages}
+
+
+def runIsolated(caseName, n_feats, workDir, timeout, prepare = False):
+
+    # run one case in a child process and collect its JSON result
+    cmd = [sys.executable, os.path.abspath(__file__), '--case', caseName,
+           '--sizes', str(n_feats), '--work-dir', workDir]
+    if prepare:
+        cmd.append('--prepare')
+    try:
+        proc = subprocess.run(cmd, capture_output = True, text = True, timeout = timeout)
+    except subprocess.TimeoutExpired:
+        return {'case': caseName, 'features': n_feats, 'ok': False, 'error': 'timeout'}
+    lines = [l for l in proc.stdout.splitlines() if l.startswith('{')]
+    if proc.returncode != 0 or not lines:
+        return {'case': caseName, 'features': n_feats, 'ok': False,
+                'error': proc.stderr.strip().splitlines()[-1:] or 'exit code ' + str(proc.returncode)}
+    return json.loads(lines[-1])
+
+
+def resultKey(result):
+    return result['case'] + '@' + str(result['features'])
+
+
+def compareToBaseline(results, baseline, tolerance):
+
+    """
+    Returns the cases whose time or peak memory exceed the baseline by more than tolerance
+    """
+
+    regressions = []
+    for result in results:
+        base = baseline.get('results', {}).get(resultKey(result))
+        if base is None:
+            continue
+        if not result.get('ok'):
+            if base.get('ok'):
+                regressions.append((resultKey(result), 'failed', base.get('seconds'), result.get('error')))
+            continue
+        for metric in ('seconds', 'peakMemoryMB'):
+            old = base.get(metric)
+            new = result.get(metric)
+            if old and new and new > old * (1.0 + tolerance):
+                regressions.append((resultKey(result), metric, old, new))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the DataTools algorithms on synthetic inputs.')
+    parser.add_argument('--sizes', default = '1000,10000,100000',
+                        help = 'comma separated feature counts (1000 up to 1000000)')
+    parser.add_argument('--cases', default = ','.join(sorted(CASES)),
+                        help = 'comma separated case names')
+    parser.add_argument('--work-dir', default = os.path.join(tempfile.gettempdir(), 'datatools_bench'),
+                        help = 'directory for generated inputs and outputs')
+    parser.add_argument('--baseline', default = os.path.join(benchDir, 'baseline.json'))
+    parser.add_argument('--update-baseline', action = 'store_true',
+                        help = 'store the results as the new baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25,
+                        help = 'allowed relative slowdown or memory growth')
+    parser.add_argument('--timeout', type = float, default = 4 * 3600)
+    parser.add_argument('--output', help = 'write all results to this JSON file')
+    parser.add_argument('--case', help = argparse.SUPPRESS)
+    parser.add_argument('--prepare', action = 'store_true', help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+
+    # child process mode: run exactly one case
+    if args.case:
+        if args.prepare:
+            print(json.dumps(prepareCase(args.case, sizes[0], args.work_dir)))
+        else:
+            print(json.dumps(runCase(args.case, sizes[0], args.work_dir)))
+        return 0
+
+    results = []
+    for caseName in [c.strip() for c in args.cases.split(',') if c.strip()]:
+        if caseName not in CASES:
+            parser.error('unknown case ' + caseName)
+        for n_feats in sizes:
+            result = runIsolated(caseName, n_feats, args.work_dir, args.timeout, prepare = True)
+            if result.get('ok'):
+                result = runIsolated(caseName, n_feats, args.work_dir, args.timeout)
+            results.append(result)
+            print('%-40s %9d  %s' % (caseName, n_feats,
+                                     '%.3f s, %s MB' % (result['seconds'], result.get('peakMemoryMB'))
+                                     if result.get('ok') else 'FAILED ' + str(result.get('error'))))
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'machine': {'platform': platform.platform(),
+                          'python': platform.python_version(),
+                          'cpus': os.cpu_count()},
+              'results': {resultKey(r): r for r in results}}
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf-8') as f:
+            json.dump(report, f, indent = 2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding = 'utf-8') as f:
+            json.dump(report, f, indent = 2)
+        print('Baseline written to ' + args.baseline)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print('No baseline found at ' + args.baseline + ', nothing to compare against')
+        return 0
+    with open(args.baseline, encoding = 'utf-8') as f:
+        baseline = json.load(f)
+    regressions = compareToBaseline(results, baseline, args.tolerance)
+    for key, metric, old, new in regressions:
+        print('REGRESSION %s: %s %s -> %s' % (key, metric, old, new))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
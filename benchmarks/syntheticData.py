@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic inputs for the benchmark harness.
+
+Polygon tessellations are written as GeoPackages in a projected CRS, tables as
+GeoPackage attribute tables. Every generator is deterministic for a given size
+and seed, so generated files are reused between benchmark runs.
+"""
+
+from PyQt5.QtCore import QVariant
+from qgis.core import (QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransformContext,
+                       QgsFeature,
+                       QgsField,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsVectorFileWriter,
+                       QgsVectorLayer)
+import numpy as np
+import os
+
+
+CRS = QgsCoordinateReferenceSystem('EPSG:25832')
+
+
+def gridShape(n_feats):
+    cols = int(np.ceil(np.sqrt(n_feats)))
+    rows = int(np.ceil(n_feats / float(cols)))
+    return cols, rows
+
+
+def writeLayer(layer, path):
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.fileEncoding = 'UTF-8'
+    error = QgsVectorFileWriter.writeAsVectorFormatV2(layer, path, QgsCoordinateTransformContext(), options)
+    if error[0] != QgsVectorFileWriter.NoError:
+        raise RuntimeError('Could not write ' + path + ': ' + str(error))
+    return path
+
+
+def countFields(layer, n_cols):
+    layer.dataProvider().addAttributes([QgsField('count_' + str(c), QVariant.Double) for c in list(range(0, n_cols))])
+    layer.updateFields()
+
+
+def tessellation(n_feats, cellSize = 100.0, jitter = 0.0, n_cols = 3, seed = 0):
+
+    """
+    Builds a polygon layer of about n_feats grid cells with count attributes
+
+    With jitter > 0 the shared grid vertices are displaced randomly (as a share
+    of the cell size), which gives an irregular but gap free tessellation.
+    """
+
+    rng = np.random.default_rng(seed)
+    cols, rows = gridShape(n_feats)
+    xs, ys = np.meshgrid(np.arange(cols + 1) * cellSize, np.arange(rows + 1) * cellSize)
+    if jitter > 0:
+        xs[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (rows - 1, cols - 1)) * cellSize
+        ys[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (rows - 1, cols - 1)) * cellSize
+    counts = rng.poisson(8, (n_feats, n_cols)).astype(float)
+
+    layer = QgsVectorLayer('Polygon', 'grid', 'memory')
+    layer.setCrs(CRS)
+    countFields(layer, n_cols)
+    feats = []
+    for k in list(range(0, n_feats)):
+        r, c = divmod(k, cols)
+        ring = [QgsPointXY(xs[r, c], ys[r, c]), QgsPointXY(xs[r, c + 1], ys[r, c + 1]),
+                QgsPointXY(xs[r + 1, c + 1], ys[r + 1, c + 1]), QgsPointXY(xs[r + 1, c], ys[r + 1, c]),
+                QgsPointXY(xs[r, c], ys[r, c])]
+        feat = QgsFeature(layer.fields())
+        feat.setGeometry(QgsGeometry.fromPolygonXY([ring]))
+        feat.setAttributes(counts[k].tolist())
+        feats.append(feat)
+    layer.dataProvider().addFeatures(feats)
+    layer.updateExtents()
+    return layer
+
+
+def table(n_rows, n_cols = 1, cardinality = 10, numeric = 0, seed = 0):
+
+    """
+    Builds an attribute table with categorical text and numeric columns
+
+    Categorical columns draw from cardinality distinct values each; numeric
+    columns are uniform on [0, 100).
+    """
+
+    rng = np.random.default_rng(seed)
+    layer = QgsVectorLayer('None', 'table', 'memory')
+    fields = [QgsField('cat_' + str(c), QVariant.String) for c in list(range(0, n_cols))]
+    fields += [QgsField('num_' + str(c), QVariant.Double) for c in list(range(0, numeric))]
+    layer.dataProvider().addAttributes(fields)
+    layer.updateFields()
+
+    cats = rng.integers(0, cardinality, (n_rows, n_cols))
+    nums = rng.uniform(0, 100, (n_rows, numeric))
+    feats = []
+    for k in list(range(0, n_rows)):
+        feat = QgsFeature(layer.fields())
+        feat.setAttributes(['v' + str(v) for v in cats[k].tolist()] + nums[k].tolist())
+        feats.append(feat)
+    layer.dataProvider().addFeatures(feats)
+    return layer
+
+
+# input kinds available to the benchmark cases
+KINDS = {
+    'regularGrid': lambda n: tessellation(n),
+    'irregularGrid': lambda n: tessellation(n, jitter = 0.3, seed = 1),
+    'coarseIrregularGrid': lambda n: tessellation(max(1, n // 10), cellSize = 100.0 * np.sqrt(10), jitter = 0.3, seed = 2),
+    'wideTable': lambda n: table(n, n_cols = 20, cardinality = 12, numeric = 4),
+    'highCardinalityTable': lambda n: table(n, n_cols = 1, cardinality = max(10, n // 10), numeric = 1),
+}
+
+
+def syntheticInput(kind, n_feats, workDir):
+
+    """
+    Returns the path of a generated input, creating it on first use
+    """
+
+    path = os.path.join(workDir, kind + '_' + str(n_feats) + '.gpkg')
+    if not os.path.isfile(path):
+        if not os.path.isdir(workDir):
+            os.makedirs(workDir)
+        tempPath = os.path.join(workDir, kind + '_' + str(n_feats) + '.part.gpkg')
+        writeLayer(KINDS[kind](n_feats), tempPath)
+        os.replace(tempPath, path)
+    return path
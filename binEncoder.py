@@ -16,11 +16,37 @@ from qgis.core import (QgsProcessing,
                        QgsFeature,
                        QgsVectorLayer,
                        QgsVectorFileWriter,
-                       QgsProject,
+                       QgsProcessingException,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterNumber,
                        QgsProcessingParameterString)
-from qgis.utils import iface
+from contextlib import ExitStack
+import os
 import pandas as pd
 import numpy as np
+import sys
+
+# make the helper modules next to this script importable
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+if scriptDir not in sys.path:
+    sys.path.append(scriptDir)
+
+from binEncoderCore import (BINNING_METHODS,
+                            autoEdges,
+                            binEncoding,
+                            edgesToBounds,
+                            loadEdges,
+                            parseBounds,
+                            saveEdges,
+                            sketchColumns)
+from layerWriter import EncodedLayerWriter
+from processingMonitor import ProcessingMonitor
+from tableLoader import (iterAttributeBatches,
+                         loadAttributeTable)
+from tableWriter import (FILE_FILTER,
+                         TableWriter,
+                         writeTable)
 
 
 class binEncoder(QgsProcessingAlgorithm):
@@ -31,9 +57,17 @@ class binEncoder(QgsProcessingAlgorithm):
 
     inputTab = 'inputTab'
     colEnc = 'colEnc'
+    method = 'method'
+    nBins = 'nBins'
+    edgesIn = 'edgesIn'
+    edgesOut = 'edgesOut'
     lw_bound = 'lw_bound'
     up_bound = 'up_bound'
+    overlap = 'overlap'
+    chunkSize = 'chunkSize'
     OUTPUT = 'output'
+    encodedLayer = 'encodedLayer'
+    stageReport = 'stageReport'
     
 
     def initAlgorithm(self, config = None):
@@ -50,24 +84,98 @@ class binEncoder(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterField(
                 self.colEnc,
-                self.tr('Columns to be one hot encoded'),
+                self.tr('Columns to be bin encoded'),
                 None,
                 self.inputTab,
-                -1
+                -1,
+                True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.method,
+                self.tr('Binning'),
+                [self.tr('Manual bounds'),
+                 self.tr('Equal count (quantiles)'),
+                 self.tr('Equal width'),
+                 self.tr('Natural breaks (Jenks on a sample)')],
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.nBins,
+                self.tr('Number of bins (automatic binning only)'),
+                QgsProcessingParameterNumber.Integer,
+                5,
+                False,
+                1
             )
         )
         
         self.addParameter(
             QgsProcessingParameterString(
                 self.lw_bound,
-                self.tr('Lower bounds of bins (comma seperated)')
+                self.tr('Lower bounds of bins (comma seperated, one ; seperated group per column or one group for all)'),
+                None,
+                False,
+                True
             )
         )
         
         self.addParameter(
             QgsProcessingParameterString(
                 self.up_bound,
-                self.tr('Upper bounds of bins (comma seperated)')
+                self.tr('Upper bounds of bins (comma seperated, one ; seperated group per column or one group for all)'),
+                None,
+                False,
+                True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.edgesIn,
+                self.tr('Reuse bin edges from file (overrides binning)'),
+                QgsProcessingParameterFile.File,
+                'json',
+                None,
+                True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.edgesOut,
+                self.tr('Save bin edges'),
+                fileFilter = '*.json',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.overlap,
+                self.tr('Overlapping bins'),
+                [self.tr('Allow (a value may fall into several bins)'),
+                 self.tr('Reject')],
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.chunkSize,
+                self.tr('Rows per batch for streaming (0 = load the whole table at once)'),
+                QgsProcessingParameterNumber.Integer,
+                0,
+                False,
+                0
             )
         )
         
@@ -76,7 +184,28 @@ class binEncoder(QgsProcessingAlgorithm):
             QgsProcessingParameterFileDestination(
                 self.OUTPUT,
                 self.tr('Output table'),
-                fileFilter = 'csv'
+                fileFilter = FILE_FILTER,
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.encodedLayer,
+                self.tr('Encoded copy of the input layer (geometry and encoded fields)'),
+                fileFilter = 'GeoPackage (*.gpkg)',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.stageReport,
+                self.tr('Stage timing report'),
+                fileFilter = '*.json',
+                optional = True,
+                createByDefault = False
             )
         )
         
@@ -86,64 +215,119 @@ class binEncoder(QgsProcessingAlgorithm):
         # get inputs
         inputTab = self.parameterAsVectorLayer(parameters, self.inputTab, context)
         colEnc = self.parameterAsFields(parameters, self.colEnc, context)
+        method = self.parameterAsEnum(parameters, self.method, context)
+        nBins = self.parameterAsInt(parameters, self.nBins, context)
+        edgesIn = self.parameterAsFile(parameters, self.edgesIn, context)
+        edgesOut = self.parameterAsFileOutput(parameters, self.edgesOut, context)
         lw_bound = self.parameterAsString(parameters, self.lw_bound, context)
         up_bound = self.parameterAsString(parameters, self.up_bound, context)
+        allowOverlap = self.parameterAsEnum(parameters, self.overlap, context) == 0
+        chunkSize = self.parameterAsInt(parameters, self.chunkSize, context)
         outTab = self.parameterAsString(parameters, self.OUTPUT, context)
+        outLayer = self.parameterAsFileOutput(parameters, self.encodedLayer, context)
+        reportPath = self.parameterAsFileOutput(parameters, self.stageReport, context)
+        
+        # set up progress reporting and stage timing
+        monitor = ProcessingMonitor(feedback, self.name(), 4)
         
 
                   
-        # convert bound strings to lists
-        lw_bound = lw_bound.split(',')
-        up_bound = up_bound.split(',')
+        if not outTab and not outLayer:
+            raise QgsProcessingException('Choose an output table, an encoded layer copy or both')
+        
+        # convert bound strings to lists per column
+        edges = None
+        try:
+            if edgesIn:
+                edges = loadEdges(edgesIn, colEnc)
+            elif method == 0:
+                if not lw_bound or not up_bound:
+                    raise ValueError('Lower and upper bounds are required for manual binning')
+                if edgesOut:
+                    raise ValueError('Only automatic or reused bins can be saved as edges')
+                lw_bound = parseBounds(lw_bound, len(colEnc))
+                up_bound = parseBounds(up_bound, len(colEnc))
+        except (OSError, ValueError) as e:
+            raise QgsProcessingException(str(e))
+        
+        methodName = BINNING_METHODS[method - 1] if method > 0 and edges is None else None
+        # derived and reused bins end at the maximum, which belongs to the top bin
+        closeTop = edges is not None or method > 0
+        
+        def deriveBounds(batches):
+            
+            # sketch the encoded columns and derive their edges
+            found = edges
+            if found is None:
+                sketches = sketchColumns(batches, colEnc)
+                try:
+                    found = {c: autoEdges(sketches[c], methodName, nBins) for c in colEnc}
+                except ValueError as e:
+                    raise QgsProcessingException(str(e))
+            if edgesOut:
+                saveEdges(edgesOut, found, methodName, nBins if methodName else None)
+            bounds = [edgesToBounds(found[c]) for c in colEnc]
+            return [l for l, u in bounds], [u for l, u in bounds]
                   
+        # stream the table in batches, encoding and appending each batch
+        if chunkSize > 0:
+            
+            # a first pass over the encoded columns only to derive the bins
+            if edges is not None or method > 0:
+                with monitor.stage('derive bins') as stage:
+                    lw_bound, up_bound = deriveBounds(iterAttributeBatches(inputTab, colEnc, chunkSize, monitor) if edges is None else [])
+                    stage.features = inputTab.featureCount() if edges is None else 0
+            
+            with monitor.stage('encode and write') as stage, ExitStack() as outputs:
+                writer = outputs.enter_context(TableWriter(outTab)) if outTab else None
+                layerWriter = outputs.enter_context(EncodedLayerWriter(inputTab, outLayer)) if outLayer else None
+                for batch in iterAttributeBatches(inputTab, None if outTab else colEnc, chunkSize, monitor):
+                    try:
+                        binDat = binEncoding(batch, colEnc, lw_bound, up_bound, allowOverlap, closeTop)
+                    except ValueError as e:
+                        raise QgsProcessingException(str(e))
+                    if writer is not None:
+                        writer.write(pd.concat([batch, binDat], axis = 1))
+                    if layerWriter is not None:
+                        layerWriter.write(binDat)
+                    stage.features += len(batch)
+            monitor.writeReport(reportPath)
+            return {self.OUTPUT: outTab, self.encodedLayer: outLayer}
+        
         # import qgis attribute table as pandas data frame
-        def qgsTabToDataFrame(inputTab):
-#             QgsMessageLog.logMessage('Converting QGIS table to pandas data frame.', level = Qgis.Info, notifyUser = True)
-            allAtts = inputTab.dataProvider().fields().names()
-            atts = pd.DataFrame([], columns = allAtts)
-            i = 0
-            for feature in inputTab.getFeatures():
-                atts.loc[i] = feature.attributes()
-                i += 1
-            return atts
-         
-        atts = qgsTabToDataFrame(inputTab)
-             
-        import pydevd;pydevd.settrace() 
+        with monitor.stage('load') as stage:
+            # the layer copy alone only needs the encoded columns
+            atts = loadAttributeTable(inputTab, None if outTab else colEnc, monitor)
+            stage.features = len(atts)
+        
+        # derive automatic bins or take the reused ones
+        if edges is not None or method > 0:
+            with monitor.stage('derive bins') as stage:
+                lw_bound, up_bound = deriveBounds([atts])
+                stage.features = len(atts) if edges is None else 0
         
         # perform bin encoding
-        def binEncoding(inDataFrame = atts, col = colEnc,
-                           lw_bound = lw_bound, up_bound = up_bound):
-         
-            # iterate over each bin
-            for b in list(range(0, len(lw_bound))):
-                 
-#                 QgsMessageLog.logMessage('Encoding bin...' + str(b) + '/' + str(len(lw_bound)) + ')', level = Qgis.Info, notifyUser = True)
-                
-                # create new bin column
-                binName = 'bin_' + lw_bound[b] + '_' + up_bound[b]
-                inDataFrame[binName] = 0
-                
-                # set 1s for rows which fall within this bin
-                cond = ((inDataFrame[col] >= float(lw_bound[b])) &
-                        (inDataFrame[col] < float(up_bound[b])))
-#                 cond = inDataFrame[col] == "01.01.1985"
-                inDataFrame[binName].iloc[np.where(cond[col] == True)[0]] = 1
-                
-            return inDataFrame
-        
-        
-        
-        outDat = binEncoding()
+        with monitor.stage('encode') as stage:
+            try:
+                binDat = binEncoding(atts, colEnc, lw_bound, up_bound, allowOverlap, closeTop)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+            stage.features = len(atts)
                  
          
-        # write encoded table to file
-#         QgsMessageLog.logMessage('Writing encoded data set to file.', , level = Qgis.Info, notifyUser = True)
-        outDat.to_csv(outTab, index = False, encoding = 'ANSI')
+        # write encoded table to file and the encoded fields to the layer copy
+        with monitor.stage('write') as stage:
+            if outTab:
+                writeTable(outTab, pd.concat([atts, binDat], axis = 1))
+            if outLayer:
+                with EncodedLayerWriter(inputTab, outLayer) as layerWriter:
+                    layerWriter.write(binDat)
+            stage.features = len(atts)
+        monitor.writeReport(reportPath)
         
         
             
-        return {self.OUTPUT: inputTab}
+        return {self.OUTPUT: outTab, self.encodedLayer: outLayer}
 
     def name(self):
         return 'binEncoder'
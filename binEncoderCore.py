@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorized bin encoding used by binEncoder.
+
+All bin bounds of a column are merged into one sorted edge array. A single
+searchsorted call maps every value to its elementary interval between two
+adjacent edges, and a small (intervals x bins) membership table turns the
+interval index into the indicator row. Overlapping bins therefore cost nothing
+extra: an interval simply belongs to several bins.
+
+Bins can also be derived automatically from a streaming quantile sketch
+(equal count, equal width or natural breaks on the sketch sample). The
+derived edges are stored in a JSON file and can be reused in later runs. Their
+last edge is the maximum of the column, so the top bin of derived bins is
+closed (lower <= value <= upper) to keep the maximum inside.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+
+from quantileSketch import QuantileSketch
+
+
+# version 1 files stored a last edge nudged above the maximum, they still load
+EDGES_VERSION = 2
+BINNING_METHODS = ['equal count', 'equal width', 'natural breaks']
+
+
+def parseBounds(text, n_cols):
+
+    """
+    Parses comma separated bounds, optionally one ';' separated group per column
+
+    Returns one list of bound strings per column; a single group is shared by
+    all columns.
+    """
+
+    groups = [[b.strip() for b in g.split(',') if b.strip()] for g in text.split(';') if g.strip()]
+    if len(groups) == 1:
+        return groups * n_cols
+    if len(groups) != n_cols:
+        raise ValueError('Expected one group of bounds or one group per column (%d), got %d' % (n_cols, len(groups)))
+    return groups
+
+
+def checkBins(lw_bound, up_bound, allowOverlap = True):
+
+    """
+    Validates the bins of one column and returns them as float arrays
+    """
+
+    if len(lw_bound) != len(up_bound):
+        raise ValueError('Number of lower bounds (%d) and upper bounds (%d) differ' % (len(lw_bound), len(up_bound)))
+    lw = np.array([float(b) for b in lw_bound])
+    up = np.array([float(b) for b in up_bound])
+    if np.any(lw >= up):
+        raise ValueError('Every lower bound has to be smaller than its upper bound')
+    if not allowOverlap:
+        order = np.argsort(lw, kind = 'stable')
+        if np.any(lw[order][1:] < up[order][:-1]):
+            raise ValueError('Bins overlap, but overlapping bins are not allowed')
+    return lw, up
+
+
+def binIndicators(values, lw, up, closeTop = False):
+
+    """
+    Returns a (values x bins) uint8 indicator matrix for lw <= value < up
+
+    With closeTop, values equal to the highest upper bound belong to the bins
+    ending there.
+    """
+
+    values = np.asarray(values, dtype = np.float64)
+    edges = np.unique(np.concatenate([lw, up]))
+
+    # intervals [edges[k], edges[k + 1]) fully covered by each bin
+    membership = ((lw[None, :] <= edges[:-1, None]) & (edges[1:, None] <= up[None, :])).astype(np.uint8)
+    membership = np.vstack([membership, np.zeros((1, len(lw)), dtype = np.uint8)])
+
+    # values outside all edges or NaN point to the empty last row
+    interval = np.searchsorted(edges, values, side = 'right') - 1
+    interval[(interval < 0) | (interval >= len(edges) - 1) | np.isnan(values)] = len(edges) - 1
+    if closeTop:
+        interval[values == edges[-1]] = len(edges) - 2
+    return membership[interval]
+
+
+def binEncoding(inDataFrame, cols, lw_bounds, up_bounds, allowOverlap = True, closeTop = False):
+
+    """
+    Bin encodes several columns, returns the indicator columns as a data frame
+
+    lw_bounds and up_bounds hold one list of bound strings per column. With a
+    single column the indicators are named bin_<lower>_<upper>, otherwise the
+    column name is used as prefix. closeTop includes the highest upper bound,
+    as needed for derived bins.
+    """
+
+    encoded = []
+    for col, lw_bound, up_bound in zip(cols, lw_bounds, up_bounds):
+        lw, up = checkBins(lw_bound, up_bound, allowOverlap)
+        values = pd.to_numeric(inDataFrame[col], errors = 'coerce').to_numpy(dtype = np.float64, na_value = np.nan)
+        prefix = '' if len(cols) == 1 else col + '_'
+        names = [prefix + 'bin_' + l + '_' + u for l, u in zip(lw_bound, up_bound)]
+        encoded.append(pd.DataFrame(binIndicators(values, lw, up, closeTop), columns = names, index = inDataFrame.index))
+    if not encoded:
+        return pd.DataFrame(index = inDataFrame.index)
+    return pd.concat(encoded, axis = 1)
+
+
+def sketchColumns(batches, cols, sketches = None):
+
+    """
+    Feeds a stream of data frames into one quantile sketch per column
+    """
+
+    if sketches is None:
+        sketches = {c: QuantileSketch() for c in cols}
+    for batch in batches:
+        for c in cols:
+            sketches[c].update(pd.to_numeric(batch[c], errors = 'coerce').to_numpy(dtype = np.float64, na_value = np.nan))
+    return sketches
+
+
+def naturalBreaks(values, n_bins):
+
+    """
+    Returns the class starts of an optimal Fisher-Jenks partition of sorted values
+
+    The partition minimises the sum of squared deviations within classes. The
+    dynamic programme works on a (values x values) cost matrix, so it is meant
+    for a sample of a few thousand values.
+    """
+
+    x = np.asarray(values, dtype = np.float64)
+    m = len(x)
+    n_bins = min(n_bins, m)
+    s1 = np.concatenate([[0.0], np.cumsum(x)])
+    s2 = np.concatenate([[0.0], np.cumsum(x * x)])
+
+    # cost[i, j]: squared deviations of the class x[i:j]
+    i = np.arange(m + 1)[:, None]
+    j = np.arange(m + 1)[None, :]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        cost = s2[j] - s2[i] - (s1[j] - s1[i]) ** 2 / (j - i)
+    cost[j <= i] = np.inf
+
+    best = cost[0]
+    starts = []
+    for c in list(range(1, n_bins)):
+        total = best[:, None] + cost
+        starts.append(np.argmin(total, axis = 0))
+        best = total[starts[-1], np.arange(m + 1)]
+
+    # trace the class starts back from the end of the data
+    breaks = []
+    end = m
+    for arg in reversed(starts):
+        end = int(arg[end])
+        breaks.append(end)
+    return sorted(breaks)
+
+
+def autoEdges(sketch, method, n_bins):
+
+    """
+    Derives bin edges of one column from its sketch
+
+    The first edge is the minimum and the last one the maximum, which the
+    closed top bin includes. Duplicate edges of heavily tied data are merged,
+    giving fewer bins; a constant column gets a single bin starting at its value.
+    """
+
+    if sketch.count == 0:
+        raise ValueError('Column has no numeric values to derive bins from')
+    if method == 'equal count':
+        edges = sketch.quantiles(np.linspace(0, 1, n_bins + 1))
+    elif method == 'equal width':
+        edges = np.linspace(sketch.min, sketch.max, n_bins + 1)
+    elif method == 'natural breaks':
+        sample = sketch.sample()
+        edges = np.concatenate([[sketch.min], sample[naturalBreaks(sample, n_bins)], [sketch.max]])
+    else:
+        raise ValueError('Unknown binning method: ' + str(method))
+    edges = np.unique(edges)
+    if len(edges) == 1:
+        edges = np.append(edges, edges[0] + max(1.0, np.spacing(edges[0])))
+    return [float(e) for e in edges]
+
+
+def edgesToBounds(edges):
+
+    """
+    Returns lower and upper bound strings of consecutive bins between edges
+    """
+
+    bounds = [repr(float(e)) for e in edges]
+    return bounds[:-1], bounds[1:]
+
+
+def saveEdges(path, edges, method = None, n_bins = None):
+    with open(path, 'w', encoding = 'utf-8') as f:
+        json.dump({'version': EDGES_VERSION, 'method': method, 'bins': n_bins,
+                   'columns': {str(c): e for c, e in edges.items()}}, f, indent = 1)
+    return path
+
+
+def loadEdges(path, cols):
+
+    """
+    Loads edges saved by saveEdges, returns the edge list of every column
+    """
+
+    with open(path, encoding = 'utf-8') as f:
+        stored = json.load(f)
+    if stored.get('version') not in (1, EDGES_VERSION) or 'columns' not in stored:
+        raise ValueError('Not a supported bin edges file: ' + path)
+    missing = [c for c in cols if c not in stored['columns']]
+    if missing:
+        raise ValueError('Bin edges file has no edges for column(s): ' + ', '.join(missing))
+    return {c: stored['columns'][c] for c in cols}
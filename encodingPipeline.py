@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+from PyQt5.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingException,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterString)
+from contextlib import ExitStack
+import os
+import sys
+
+# make the helper modules next to this script importable
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+if scriptDir not in sys.path:
+    sys.path.append(scriptDir)
+
+from encodingPipelineCore import (EncodingPipeline,
+                                  buildSteps,
+                                  parseSpecs,
+                                  stepColumns)
+from layerWriter import EncodedLayerWriter
+from processingMonitor import ProcessingMonitor
+from tableLoader import (iterAttributeBatches,
+                         loadAttributeTable)
+from tableWriter import (FILE_FILTER,
+                         TableWriter)
+
+
+class encodingPipeline(QgsProcessingAlgorithm):
+
+    """
+    This script applies several encodings (one hot, bin, hashed, passthrough)
+    to a given spreadsheet together and writes one output table
+    """
+
+    inputTab = 'inputTab'
+    specs = 'specs'
+    chunkSize = 'chunkSize'
+    threads = 'threads'
+    OUTPUT = 'output'
+    encodedLayer = 'encodedLayer'
+    stageReport = 'stageReport'
+
+
+    def initAlgorithm(self, config = None):
+
+        # define input parameters
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.inputTab,
+                self.tr('Input table'),
+                [QgsProcessing.TypeFile]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.specs,
+                self.tr('Encoding specs (JSON list or path of a JSON file)'),
+                None,
+                True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.chunkSize,
+                self.tr('Rows per batch for streaming (0 = load the whole table at once; '
+                        'streaming reads the table twice if a step has to be fitted first)'),
+                QgsProcessingParameterNumber.Integer,
+                0,
+                False,
+                0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.threads,
+                self.tr('Encoding steps run in parallel (0 = all processor cores)'),
+                QgsProcessingParameterNumber.Integer,
+                1,
+                False,
+                0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.OUTPUT,
+                self.tr('Output table'),
+                fileFilter = FILE_FILTER,
+                optional = True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.encodedLayer,
+                self.tr('Encoded copy of the input layer (geometry and encoded fields)'),
+                fileFilter = 'GeoPackage (*.gpkg)',
+                optional = True,
+                createByDefault = False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.stageReport,
+                self.tr('Stage timing report'),
+                fileFilter = '*.json',
+                optional = True,
+                createByDefault = False
+            )
+        )
+
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+        # get inputs
+        inputTab = self.parameterAsVectorLayer(parameters, self.inputTab, context)
+        specs = self.parameterAsString(parameters, self.specs, context)
+        chunkSize = self.parameterAsInt(parameters, self.chunkSize, context)
+        threads = self.parameterAsInt(parameters, self.threads, context)
+        outTab = self.parameterAsString(parameters, self.OUTPUT, context)
+        outLayer = self.parameterAsFileOutput(parameters, self.encodedLayer, context)
+        reportPath = self.parameterAsFileOutput(parameters, self.stageReport, context)
+
+        # set up progress reporting and stage timing
+        monitor = ProcessingMonitor(feedback, self.name(), 3)
+
+        if not outTab and not outLayer:
+            raise QgsProcessingException('Choose an output table, an encoded layer copy or both')
+
+        # create one step per spec, reading vocabularies and edges up front
+        try:
+            steps = buildSteps(parseSpecs(specs), inputTab.fields().names())
+        except (OSError, ValueError) as e:
+            raise QgsProcessingException(str(e))
+        columns = stepColumns(steps)
+
+        with EncodingPipeline(steps, threads) as pipeline:
+
+            # the whole table is read once and shared by fitting and encoding
+            if chunkSize <= 0:
+                with monitor.stage('load') as stage:
+                    atts = loadAttributeTable(inputTab, columns, monitor)
+                    stage.features = len(atts)
+                batches = lambda cols: [atts]
+            else:
+                batches = lambda cols: iterAttributeBatches(inputTab, cols, chunkSize, monitor)
+
+            # fit the steps which have to see the data first, over their columns only
+            if pipeline.needsFit:
+                with monitor.stage('fit') as stage:
+                    for batch in batches(stepColumns(steps, True)):
+                        pipeline.fit(batch)
+                        stage.features += len(batch)
+            try:
+                pipeline.finish()
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+
+            # encode every batch with all steps and append it to the outputs,
+            # the layer copy already holds the passthrough columns
+            with monitor.stage('encode and write') as stage, ExitStack() as outputs:
+                writer = outputs.enter_context(TableWriter(outTab)) if outTab else None
+                layerWriter = outputs.enter_context(EncodedLayerWriter(inputTab, outLayer)) if outLayer else None
+                for batch in batches(columns):
+                    try:
+                        parts = pipeline.transform(batch)
+                        if writer is not None:
+                            writer.write(pipeline.join(parts))
+                    except ValueError as e:
+                        raise QgsProcessingException(str(e))
+                    if layerWriter is not None:
+                        layerWriter.write(pipeline.join(parts, passthrough = False))
+                    stage.features += len(batch)
+        monitor.writeReport(reportPath)
+
+        return {self.OUTPUT: outTab, self.encodedLayer: outLayer}
+
+    def name(self):
+        return 'encodingPipeline'
+
+    def displayName(self):
+        return self.tr('encodingPipeline')
+
+    def group(self):
+        return self.tr('Raumanalaysen - Christian Mueller')
+
+    def groupId(self):
+        return 'Raumanalysen'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return encodingPipeline()
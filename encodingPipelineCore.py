@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fused encoding steps used by encodingPipeline.
+
+A pipeline is a list of specs, each applying one encoder to some columns:
+
+    [{"type": "onehot", "columns": ["landuse"], "vocabulary": "landuse.json"},
+     {"type": "bin", "columns": ["area"], "method": "equal count", "bins": 5},
+     {"type": "bin", "columns": ["age"], "lower": "0,18,65", "upper": "18,65,120"},
+     {"type": "hashed", "columns": ["owner"], "buckets": 256, "prefix": "owner_"},
+     {"type": "passthrough", "columns": ["id"]}]
+
+Steps needing to see the data before encoding (one hot without vocabulary,
+automatic bins) are fitted batch by batch first, then every batch is encoded
+by all steps and the results are joined side by side. Steps are independent,
+so they can run concurrently on the same batch. The module does not depend on
+QGIS.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import pandas as pd
+
+from binEncoderCore import (BINNING_METHODS,
+                            autoEdges,
+                            binEncoding,
+                            edgesToBounds,
+                            loadEdges,
+                            parseBounds,
+                            sketchColumns)
+from oneHotEncoderCore import (HASH_PREFIX,
+                               loadVocabulary,
+                               oneHotDense,
+                               oneHotHashed,
+                               vocabularyLookup)
+from processPool import resolveProcesses
+
+
+class OneHotStep(object):
+
+    """
+    Dense one hot indicators, from a vocabulary or from the fitted categories
+    """
+
+    def __init__(self, columns, vocabulary = None):
+        self.columns = columns
+        self.categories = None
+        self.other = False
+        if vocabulary:
+            vocabulary = loadVocabulary(vocabulary)
+            self.categories = vocabularyLookup(vocabulary, columns)
+            self.other = vocabulary['other']
+        self.seen = {c: {} for c in columns}
+
+    @property
+    def needsFit(self):
+        return self.categories is None
+
+    def fit(self, batch):
+        for c in self.columns:
+            known = self.seen[c]
+            for u in pd.factorize(batch[c], sort = False)[1]:
+                if u not in known:
+                    known[u] = len(known)
+
+    def finish(self):
+        if self.categories is None:
+            self.categories = {c: list(self.seen[c]) for c in self.columns}
+
+    def transform(self, batch):
+        return oneHotDense(batch, self.columns, self.categories, self.other)
+
+
+class BinStep(object):
+
+    """
+    Bin indicators from manual bounds, saved edges or automatic binning
+    """
+
+    def __init__(self, columns, lower = None, upper = None, method = None, bins = 5, edges = None, overlap = True):
+        self.columns = columns
+        self.method = method
+        self.bins = int(bins)
+        self.overlap = overlap
+        self.sketches = None
+        self.closeTop = bool(edges or method)
+        if edges:
+            self.setEdges(loadEdges(edges, columns))
+        elif method:
+            if method not in BINNING_METHODS:
+                raise ValueError('Unknown binning method: ' + str(method))
+            self.lower = None
+            self.sketches = sketchColumns([], columns)
+        else:
+            if not lower or not upper:
+                raise ValueError('Bin step needs lower and upper bounds, a method or an edges file')
+            self.lower = parseBounds(lower, len(columns))
+            self.upper = parseBounds(upper, len(columns))
+
+    def setEdges(self, edges):
+        bounds = [edgesToBounds(edges[c]) for c in self.columns]
+        self.lower = [l for l, u in bounds]
+        self.upper = [u for l, u in bounds]
+
+    @property
+    def needsFit(self):
+        return self.lower is None
+
+    def fit(self, batch):
+        sketchColumns([batch], self.columns, self.sketches)
+
+    def finish(self):
+        if self.lower is None:
+            self.setEdges({c: autoEdges(self.sketches[c], self.method, self.bins) for c in self.columns})
+
+    def transform(self, batch):
+        return binEncoding(batch, self.columns, self.lower, self.upper, self.overlap, self.closeTop)
+
+
+class HashedStep(object):
+
+    """
+    Signed hashed indicators in a fixed number of bucket columns
+    """
+
+    needsFit = False
+
+    def __init__(self, columns, buckets = 1024, prefix = HASH_PREFIX):
+        self.columns = columns
+        self.buckets = int(buckets)
+        self.prefix = prefix
+
+    def fit(self, batch):
+        pass
+
+    def finish(self):
+        pass
+
+    def transform(self, batch):
+        return oneHotHashed(batch, self.columns, self.buckets, self.prefix)
+
+
+class PassthroughStep(object):
+
+    """
+    Copies columns unchanged into the output
+    """
+
+    needsFit = False
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def fit(self, batch):
+        pass
+
+    def finish(self):
+        pass
+
+    def transform(self, batch):
+        return batch[self.columns]
+
+
+STEP_TYPES = {'onehot': OneHotStep,
+              'bin': BinStep,
+              'hashed': HashedStep,
+              'passthrough': PassthroughStep}
+
+
+def parseSpecs(text):
+
+    """
+    Parses pipeline specs given as JSON text or as path of a JSON file
+    """
+
+    text = text.strip()
+    if not text.startswith('['):
+        if not os.path.isfile(text):
+            raise ValueError('Specs have to be a JSON list or the path of a JSON file')
+        with open(text, encoding = 'utf-8') as f:
+            text = f.read()
+    specs = json.loads(text)
+    if not isinstance(specs, list) or not specs:
+        raise ValueError('Specs have to be a non-empty JSON list')
+    return specs
+
+
+def buildSteps(specs, fields):
+
+    """
+    Creates the steps of all specs, checking their columns against the fields
+    """
+
+    steps = []
+    for spec in specs:
+        spec = dict(spec)
+        kind = spec.pop('type', None)
+        if kind not in STEP_TYPES:
+            raise ValueError('Unknown encoding type %r, expected one of %s' % (kind, ', '.join(STEP_TYPES)))
+        columns = spec.pop('columns', None)
+        if isinstance(columns, str):
+            columns = [columns]
+        if not columns:
+            raise ValueError('Encoding spec of type %s has no columns' % kind)
+        missing = [c for c in columns if c not in fields]
+        if missing:
+            raise ValueError('Unknown column(s) in %s spec: %s' % (kind, ', '.join(missing)))
+        try:
+            steps.append(STEP_TYPES[kind](columns, **spec))
+        except TypeError as e:
+            raise ValueError('Invalid options for %s spec: %s' % (kind, e))
+    return steps
+
+
+def stepColumns(steps, fitOnly = False):
+
+    """
+    Returns the input columns used by the steps (or by those needing a fit)
+    """
+
+    columns = []
+    for step in steps:
+        if fitOnly and not step.needsFit:
+            continue
+        columns.extend(c for c in step.columns if c not in columns)
+    return columns
+
+
+class EncodingPipeline(object):
+
+    """
+    Fits and applies all steps, optionally running the steps concurrently
+    """
+
+    def __init__(self, steps, threads = 1):
+        self.steps = steps
+        self.threads = resolveProcesses(threads)
+        self.pool = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def map(self, function, steps):
+        if self.pool is None:
+            return [function(step) for step in steps]
+        return list(self.pool.map(function, steps))
+
+    @property
+    def needsFit(self):
+        return any(step.needsFit for step in self.steps)
+
+    def fit(self, batch):
+        self.map(lambda step: step.fit(batch), [s for s in self.steps if s.needsFit])
+
+    def finish(self):
+        for step in self.steps:
+            step.finish()
+
+    def transform(self, batch):
+
+        """
+        Encodes one batch with all steps, returns one data frame per step
+        """
+
+        return self.map(lambda step: step.transform(batch), self.steps)
+
+    def join(self, parts, passthrough = True):
+
+        """
+        Joins the step results side by side in spec order, optionally without passthrough columns
+        """
+
+        frames = [part for part, step in zip(parts, self.steps) if passthrough or not isinstance(step, PassthroughStep)]
+        if not frames:
+            return pd.DataFrame(index = parts[0].index)
+        return pd.concat(frames, axis = 1)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sidecar cache for arrays derived purely from layer geometries.
+
+Entries are stored as .npc files next to the data source: the full fingerprint
+of the geometries and CRS they were derived from, followed by a .npy stream
+that is memory-mapped on load. The file name carries the first characters of the
+fingerprint; entries of the same data source and tag with any other
+fingerprint are stale and get removed whenever a new entry is stored.
+"""
+
+from qgis.core import (QgsFeatureRequest,
+                       QgsProviderRegistry)
+import glob
+import hashlib
+import numpy as np
+import os
+import tempfile
+
+
+# bump whenever the layout of cached arrays changes
+CACHE_VERSION = '2'
+
+# fingerprint characters in the file name and bytes of the fingerprint block before the array
+NAME_KEY_LENGTH = 16
+KEY_BYTES = 64
+CACHE_EXTENSION = '.npc'
+
+
+def layerFingerprint(layer, *extra):
+
+    """
+    Hashes the CRS, feature ids and geometries of a layer
+    """
+
+    digest = hashlib.sha1()
+    digest.update(CACHE_VERSION.encode('utf-8'))
+    for e in extra:
+        digest.update(str(e).encode('utf-8'))
+    digest.update(layer.crs().toWkt().encode('utf-8'))
+    request = QgsFeatureRequest().setNoAttributes()
+    for feat in layer.getFeatures(request):
+        digest.update(str(feat.id()).encode('utf-8'))
+        digest.update(bytes(feat.geometry().asWkb()))
+    return digest.hexdigest()
+
+
+def sidecarStem(layer):
+
+    """
+    Returns the path prefix for sidecar files of a file based layer, else None
+    """
+
+    parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+    path = parts.get('path')
+    if not path or not os.path.isfile(path):
+        return None
+    stem = os.path.splitext(path)[0]
+    if parts.get('layerName'):
+        stem += '_' + parts['layerName']
+    return stem
+
+
+def cachePath(stem, tag, key):
+    return stem + '.' + key[:NAME_KEY_LENGTH] + '.' + tag + CACHE_EXTENSION
+
+
+def cachePattern(stem, tag):
+
+    # glob matching exactly the entries of this stem and tag, not those of
+    # another source whose name merely starts with the same stem
+    return glob.escape(stem) + '.' + '[0-9a-f]' * NAME_KEY_LENGTH + '.' + tag + CACHE_EXTENSION
+
+
+def loadCachedArray(stem, tag, key):
+
+    """
+    Memory-maps a cached array, returns None on a cache miss
+    """
+
+    if stem is None:
+        return None
+    path = cachePath(stem, tag, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            if f.read(KEY_BYTES).rstrip(b' ') != key.encode('ascii'):
+                return None
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if dtype.hasobject:
+            return None
+        return np.memmap(path, dtype = dtype, mode = 'r', offset = offset, shape = shape,
+                         order = 'F' if fortranOrder else 'C')
+    except (OSError, ValueError):
+        return None
+
+
+def storeCachedArray(stem, tag, key, array):
+
+    """
+    Stores an array for a fingerprint and evicts stale entries of the same tag
+    """
+
+    if stem is None:
+        return None
+    if len(key) > KEY_BYTES:
+        raise ValueError('Cache keys are limited to %d characters' % KEY_BYTES)
+    path = cachePath(stem, tag, key)
+    for stale in glob.glob(cachePattern(stem, tag)):
+        if stale != path:
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                # already evicted by a concurrent run
+                pass
+            except OSError:
+                return None
+
+    # write through a temporary file of this process, concurrent runs storing
+    # the same entry each replace it with a complete file
+    try:
+        handle, tempPath = tempfile.mkstemp(prefix = os.path.basename(path) + '.', suffix = '.tmp',
+                                            dir = os.path.dirname(path) or '.')
+    except OSError:
+        return None
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(key.encode('ascii').ljust(KEY_BYTES, b' '))
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tempPath, path)
+    except OSError:
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        return None
+    return path
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Optional geometry preparation before the shiftShapes overlay.
+
+Highly detailed boundaries and near-coincident edges make the overlay slow
+and produce many tiny intersection fragments. The preparation
+
+    - snaps all vertices to a precision grid,
+    - simplifies boundaries within a distance tolerance,
+    - drops polygon parts and intersection fragments below an area threshold,
+
+and keeps count of the removed vertices and fragments and of the area that
+moved as a result, so the effect on the weights can be judged.
+"""
+
+from qgis.core import QgsGeometry
+import numpy as np
+
+
+class GeometryPrep(object):
+
+    """
+    Snapping, simplification and sliver filter with a running report
+    """
+
+    def __init__(self, gridSize = 0, tolerance = 0, minArea = 0):
+        self.gridSize = float(gridSize)
+        self.tolerance = float(tolerance)
+        self.minArea = float(minArea)
+        self.report = {}
+
+    @property
+    def active(self):
+        return self.gridSize > 0 or self.tolerance > 0 or self.minArea > 0
+
+    def key(self):
+
+        # identifies the settings in cache keys and run states
+        if not self.active:
+            return ''
+        return 'prep:%r,%r,%r' % (self.gridSize, self.tolerance, self.minArea)
+
+    def prepareGeometry(self, geom):
+        if self.gridSize > 0:
+            geom = geom.snappedToGrid(self.gridSize, self.gridSize)
+        if self.tolerance > 0:
+            geom = geom.simplify(self.tolerance)
+        if (self.gridSize > 0 or self.tolerance > 0) and not geom.isEmpty() and not geom.isGeosValid():
+            geom = geom.makeValid()
+        slivers = 0
+        if self.minArea > 0 and not geom.isEmpty():
+            parts = geom.asGeometryCollection()
+            kept = [part for part in parts if part.area() >= self.minArea]
+            slivers = len(parts) - len(kept)
+            if slivers:
+                geom = QgsGeometry.collectGeometry(kept) if kept else QgsGeometry()
+        return geom, slivers
+
+    def apply(self, geoms, kind):
+
+        """
+        Prepares a list of geometries and records the changes under kind
+        """
+
+        if not self.active:
+            return geoms
+        prepared = []
+        vertices = [0, 0]
+        area = np.zeros((len(geoms), 2))
+        slivers = 0
+        emptied = 0
+        for i, geom in enumerate(geoms):
+            if geom.isEmpty():
+                prepared.append(geom)
+                continue
+            newGeom, removed = self.prepareGeometry(geom)
+            vertices[0] += geom.constGet().nCoordinates()
+            vertices[1] += 0 if newGeom.isEmpty() else newGeom.constGet().nCoordinates()
+            area[i] = (geom.area(), newGeom.area())
+            slivers += removed
+            emptied += int(newGeom.isEmpty())
+            prepared.append(newGeom)
+        self.report[kind] = {'verticesBefore': int(vertices[0]),
+                             'verticesRemoved': int(vertices[0] - vertices[1]),
+                             'sliverParts': int(slivers),
+                             'featuresEmptied': int(emptied),
+                             'areaBefore': float(area[:, 0].sum()),
+                             'areaShifted': float(np.abs(area[:, 1] - area[:, 0]).sum())}
+        return prepared
+
+    def filterPairs(self, src, tgt, area):
+
+        """
+        Drops intersection fragments below the area threshold
+        """
+
+        if self.minArea <= 0:
+            return src, tgt, area
+        keep = area >= self.minArea
+        fragments = self.report.setdefault('fragments', {'removed': 0, 'areaRemoved': 0.0, 'areaTotal': 0.0})
+        fragments['removed'] += int(np.sum(~keep))
+        fragments['areaRemoved'] += float(area[~keep].sum())
+        fragments['areaTotal'] += float(area.sum())
+        return src[keep], tgt[keep], area[keep]
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk GeoPackage writer shared by the tools producing polygon layers.
+
+Features are streamed through OGR into a fresh GeoPackage inside a single
+SQLite transaction, with synchronous writes and the rollback journal on disk
+switched off while loading. The spatial index is created once after all
+features arrived instead of being updated per insert, and text is stored as
+UTF-8. Attribute values can come straight from (fields x features) arrays,
+so results never have to be copied into a memory layer first.
+"""
+
+from PyQt5.QtCore import (Qt, QVariant)
+from qgis.core import (NULL,
+                       QgsFeatureRequest,
+                       QgsProcessingException,
+                       QgsWkbTypes)
+import numpy as np
+import os
+
+try:
+    from osgeo import ogr, osr
+except ImportError:
+    ogr = None
+
+
+# pragmas applied while loading, the file is discarded anyway if the load fails
+LOAD_PRAGMAS = ['PRAGMA synchronous = OFF',
+                'PRAGMA journal_mode = MEMORY',
+                'PRAGMA cache_size = -262144',
+                'PRAGMA temp_store = MEMORY']
+
+FID_COLUMN = 'fid'
+GEOMETRY_COLUMN = 'geom'
+
+
+def ogrFieldType(field):
+
+    # OGR type and subtype of a QgsField
+    kind = field.type()
+    if kind == QVariant.Bool:
+        return ogr.OFTInteger, ogr.OFSTBoolean
+    if kind in (QVariant.Int, QVariant.UInt):
+        return ogr.OFTInteger, ogr.OFSTNone
+    if kind in (QVariant.LongLong, QVariant.ULongLong):
+        return ogr.OFTInteger64, ogr.OFSTNone
+    if kind == QVariant.Double:
+        return ogr.OFTReal, ogr.OFSTNone
+    if kind == QVariant.Date:
+        return ogr.OFTDate, ogr.OFSTNone
+    if kind == QVariant.DateTime:
+        return ogr.OFTDateTime, ogr.OFSTNone
+    if kind == QVariant.Time:
+        return ogr.OFTTime, ogr.OFSTNone
+    return ogr.OFTString, ogr.OFSTNone
+
+
+def ogrGeometryType(wkbType):
+
+    # QGIS and OGR share the codes of the flat types, Z and M are flags in OGR
+    code = int(QgsWkbTypes.flatType(wkbType))
+    if QgsWkbTypes.hasZ(wkbType):
+        code = ogr.GT_SetZ(code)
+    if QgsWkbTypes.hasM(wkbType):
+        code = ogr.GT_SetM(code)
+    return code
+
+
+def ogrValue(value):
+
+    # plain python value, dates as ISO strings, None for NULL
+    if value is None or value == NULL:
+        return None
+    if hasattr(value, 'toString') and hasattr(value, 'isValid'):
+        return value.toString(Qt.ISODate) if value.isValid() else None
+    return value
+
+
+class GpkgWriter(object):
+
+    """
+    Streams features into a new GeoPackage layer inside one transaction
+    """
+
+    def __init__(self, path, fields, wkbType, crs, layerName = None):
+        if ogr is None:
+            raise QgsProcessingException('Writing GeoPackages requires the GDAL Python bindings')
+        self.path = path
+        self.layerName = layerName or os.path.splitext(os.path.basename(path))[0]
+        self.features = 0
+        if os.path.exists(path):
+            os.remove(path)
+        self.ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+        if self.ds is None:
+            raise QgsProcessingException('Could not create ' + path)
+        srs = None
+        if crs.isValid():
+            srs = osr.SpatialReference()
+            srs.ImportFromWkt(crs.toWkt())
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.layer = self.ds.CreateLayer(self.layerName, srs, ogrGeometryType(wkbType),
+                                         ['FID=' + FID_COLUMN, 'GEOMETRY_NAME=' + GEOMETRY_COLUMN, 'SPATIAL_INDEX=NO'])
+
+        # the fid column of the source is replaced by the one of the new layer
+        self.fieldIdx = []
+        for i, field in enumerate(fields):
+            if field.name().lower() == FID_COLUMN:
+                continue
+            fieldType, subType = ogrFieldType(field)
+            definition = ogr.FieldDefn(field.name(), fieldType)
+            definition.SetSubType(subType)
+            if self.layer.CreateField(definition) != 0:
+                raise QgsProcessingException('Could not create the field ' + field.name() + ' in ' + path)
+            self.fieldIdx.append(i)
+        self.definition = self.layer.GetLayerDefn()
+
+        for pragma in LOAD_PRAGMAS:
+            self.ds.ExecuteSQL(pragma)
+        self.ds.StartTransaction()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def addFeature(self, geometry, attributes):
+
+        """
+        Adds one feature from a QgsGeometry and its attributes in field order
+        """
+
+        feat = ogr.Feature(self.definition)
+        if geometry is not None and not geometry.isNull():
+            feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+        for k, i in enumerate(self.fieldIdx):
+            value = ogrValue(attributes[i])
+            if value is None:
+                feat.SetFieldNull(k)
+            else:
+                feat.SetField(k, value)
+        if self.layer.CreateFeature(feat) != 0:
+            raise QgsProcessingException('Could not write feature %d to %s' % (self.features, self.path))
+        self.features += 1
+
+    def close(self):
+
+        """
+        Commits all features and builds the spatial index
+        """
+
+        if self.ds is None:
+            return
+        if self.ds.CommitTransaction() != 0:
+            self.abort()
+            raise QgsProcessingException('Could not commit the features to ' + self.path)
+        self.ds.ExecuteSQL("SELECT CreateSpatialIndex('%s', '%s')" % (self.layerName.replace("'", "''"), GEOMETRY_COLUMN))
+        self.layer = None
+        self.ds = None
+
+    def abort(self):
+
+        # drop the incomplete file
+        if self.ds is None:
+            return
+        self.ds.RollbackTransaction()
+        self.layer = None
+        self.ds = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def writeLayer(layer, path, fieldNames = (), values = None, fids = None, extraFields = (), keepMissing = False,
+               monitor = None):
+
+    """
+    Writes a layer to a GeoPackage, taking some fields from an array
+
+    values is a (fields x features) array for fieldNames with its columns
+    ordered like fids; NaN is written as NULL, or keeps the value of the layer
+    with keepMissing. Fields of fieldNames missing in the layer have to be
+    given as QgsFields in extraFields. Returns the number of written features.
+    """
+
+    fields = layer.fields()
+    for field in extraFields:
+        fields.append(field)
+    valueIdx = [fields.indexOf(name) for name in fieldNames]
+    if values is not None:
+        values = np.array(values, dtype = np.float64, ndmin = 2)
+        position = {int(fid): pos for pos, fid in enumerate(fids)}
+    n_extra = len(extraFields)
+    total = layer.featureCount()
+    with GpkgWriter(path, fields, layer.wkbType(), layer.crs()) as writer:
+        for feat in layer.getFeatures(QgsFeatureRequest()):
+            attrs = feat.attributes() + [None] * n_extra
+            if values is not None:
+                pos = position[feat.id()]
+                for v, idx in enumerate(valueIdx):
+                    if not np.isnan(values[v, pos]):
+                        attrs[idx] = float(values[v, pos])
+                    elif not keepMissing:
+                        attrs[idx] = None
+            writer.addFeature(feat.geometry(), attrs)
+            if monitor is not None:
+                monitor.progress(writer.features, total)
+    return writer.features
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Writes encoded columns into a GeoPackage copy of the encoded layer.
+
+The input layer is copied once with its geometries. All encoded fields are then
+created with a single addAttributes call and filled with batched
+changeAttributeValues calls inside one transaction, so the indicators end up
+next to the geometries without a table join. Rows are matched by position: the
+n-th encoded row belongs to the n-th feature, which holds as long as both the
+encoded table and the copy are read in the natural feature order.
+"""
+
+from PyQt5.QtCore import QVariant
+from qgis.core import (QgsFeatureRequest,
+                       QgsField,
+                       QgsProcessingException,
+                       QgsTransaction,
+                       QgsVectorFileWriter,
+                       QgsVectorLayer)
+import numpy as np
+import os
+
+
+def fieldForColumn(name, series):
+
+    # choose the QGIS field type matching a data frame column
+    kind = series.dtype.kind
+    if kind in 'iub':
+        # indicators (uint8, int8) and anything else fitting into 32 bit become Int
+        if kind == 'b' or series.dtype.itemsize < 4 or (kind == 'i' and series.dtype.itemsize == 4):
+            return QgsField(name, QVariant.Int)
+        return QgsField(name, QVariant.LongLong)
+    if kind == 'f':
+        return QgsField(name, QVariant.Double)
+    return QgsField(name, QVariant.String)
+
+
+def columnValues(series):
+
+    # plain python values with None for missing ones
+    values = series.astype(object).where(series.notna(), None)
+    if series.dtype.kind not in 'iubf':
+        values = values.map(lambda v: v if v is None else str(v))
+    return values.tolist()
+
+
+class EncodedLayerWriter(object):
+
+    """
+    Appends encoded data frames as new fields to a GeoPackage copy of a layer
+    """
+
+    def __init__(self, layer, path, batchSize = 50000):
+        self.path = path
+        self.batchSize = batchSize
+        self.rows = 0
+        self.fieldIdx = None
+        self.transaction = None
+
+        # copy the input layer including its geometries
+        if os.path.exists(path):
+            os.remove(path)
+        error = QgsVectorFileWriter.writeAsVectorFormat(layer, path, 'UTF-8', layer.crs(), 'GPKG')
+        if error[0] != QgsVectorFileWriter.NoError:
+            raise QgsProcessingException('Could not copy the input layer to ' + path + ': ' + str(error[1]))
+        self.layer = QgsVectorLayer(path, os.path.splitext(os.path.basename(path))[0], 'ogr')
+        if not self.layer.isValid():
+            raise QgsProcessingException('Could not open the layer copy ' + path)
+        self.provider = self.layer.dataProvider()
+
+        # feature ids of the copy in their natural order
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setNoAttributes()
+        self.fids = np.fromiter((f.id() for f in self.layer.getFeatures(request)), dtype = np.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.rollback()
+        return False
+
+    def createFields(self, frame):
+
+        # add all encoded fields at once, then open the transaction for the values
+        existing = set(self.layer.fields().names())
+        clashes = [str(c) for c in frame.columns if str(c) in existing]
+        if clashes:
+            raise QgsProcessingException('Encoded fields already exist in the input layer: ' + ', '.join(clashes))
+        if len(set(frame.columns)) != len(frame.columns):
+            raise QgsProcessingException('Duplicate encoded field names')
+        if not self.provider.addAttributes([fieldForColumn(str(c), frame[c]) for c in frame.columns]):
+            raise QgsProcessingException('Could not add the encoded fields to ' + self.path)
+        self.layer.updateFields()
+        self.fieldIdx = [self.layer.fields().indexOf(str(c)) for c in frame.columns]
+
+        if QgsTransaction.supportsTransaction([self.layer]):
+            self.transaction = QgsTransaction.create([self.layer])
+            ok, error = self.transaction.begin()
+            if not ok:
+                raise QgsProcessingException('Could not start a transaction on ' + self.path + ': ' + error)
+
+    def write(self, frame):
+
+        """
+        Fills the encoded values of the next len(frame) features
+        """
+
+        if self.fieldIdx is None:
+            self.createFields(frame)
+        if self.rows + len(frame) > len(self.fids):
+            raise QgsProcessingException('More encoded rows than features in the input layer')
+        values = [columnValues(frame[c]) for c in frame.columns]
+        for start in list(range(0, len(frame), self.batchSize)):
+            stop = min(start + self.batchSize, len(frame))
+            fids = self.fids[self.rows + start:self.rows + stop].tolist()
+            changes = {fid: dict(zip(self.fieldIdx, row))
+                       for fid, row in zip(fids, zip(*[v[start:stop] for v in values]))}
+            if not self.provider.changeAttributeValues(changes):
+                raise QgsProcessingException('Could not write encoded values to ' + self.path)
+        self.rows += len(frame)
+
+    def close(self):
+
+        """
+        Commits the values, all features have to be encoded by now
+        """
+
+        if self.rows != len(self.fids) and self.fieldIdx is not None:
+            self.rollback()
+            raise QgsProcessingException('Encoded %d rows for %d features' % (self.rows, len(self.fids)))
+        if self.transaction is not None:
+            ok, error = self.transaction.commit()
+            self.transaction = None
+            if not ok:
+                raise QgsProcessingException('Could not commit the encoded values to ' + self.path + ': ' + error)
+        self.layer = None
+        self.provider = None
+
+    def rollback(self):
+        if self.transaction is not None:
+            self.transaction.rollback()
+            self.transaction = None
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""
+Array based smoothing engine behind abideMinCases.
+
+Values are held in a float array per field, indexed by the position of the
+feature within the adjacency graph. The engine does not depend on QGIS.
+"""
+
+import heapq
+import numpy as np
+
+from processPool import (createProcessPool,
+                         resolveProcesses)
+
+
+def sweepField(values, indptr, indices, thresh, worklist = None):
+
+    """
+    Averages every value below thresh with its adjacent values (one sweep)
+
+    Without a worklist every feature is visited in order. With a worklist only
+    the listed features are visited, plus any later feature pulled below the
+    threshold during the sweep, which gives the same result as a full sweep as
+    long as the worklist covers all features below the threshold.
+    Returns a boolean array flagging the features whose value changed.
+    """
+
+    n_feats = len(values)
+    changed = np.zeros(n_feats, dtype = bool)
+
+    # create container for information about processed feature pairs
+    allProc = set()
+
+    # visit features in ascending order, queueing partners pulled below the threshold
+    if worklist is None:
+        queue = list(range(0, n_feats))
+    else:
+        queue = sorted(set(int(i) for i in worklist))
+    queued = np.zeros(n_feats, dtype = bool)
+    queued[queue] = True
+
+    while queue:
+        i = heapq.heappop(queue)
+
+        # get active if attribute value is lower than defined threshold
+        to_val = values[i]
+        if not to_val < thresh:
+            continue
+
+        # sort adjacent features by attribute values
+        adjIdx = indices[indptr[i]:indptr[i + 1]]
+        adjPairs = sorted((values[j], j) for j in adjIdx.tolist() if not np.isnan(values[j]))
+
+        # iterate over each appropriate adjacent feature pair as long as the threshold is not reached
+        new_val = to_val
+        for comp_val, j in adjPairs:
+
+            pair = (i, j) if i < j else (j, i)
+            if (pair not in allProc) and (new_val < thresh):
+
+                # calculate new value as mean and update both features
+                comp_val = values[j]
+                new_val = (to_val + comp_val) / 2
+                if new_val != comp_val:
+                    changed[j] = True
+                if new_val != to_val:
+                    changed[i] = True
+                values[j] = new_val
+                values[i] = new_val
+
+                # collect information about this processed feature pair
+                allProc.add(pair)
+
+                # revisit later partners which are now below the threshold
+                if j > i and not queued[j] and new_val < thresh:
+                    queued[j] = True
+                    heapq.heappush(queue, j)
+
+                # update value in question
+                to_val = new_val
+
+    return changed
+
+
+def abideMinCases(values, indptr, indices, thresh, maxIter, converge = False, callback = None):
+
+    """
+    Runs up to maxIter sweeps over each row of a (fields x features) value array
+
+    In convergence mode each sweep only examines features below thresh and
+    the run stops as soon as a sweep leaves all values unchanged.
+    An optional callback(done, total) is called after every sweep.
+    Returns the new values and the number of sweeps actually used.
+    """
+
+    values = np.array(values, dtype = np.float64, ndmin = 2)
+    usedIter = 0
+    for r, row in enumerate(values):
+        for l in list(range(0, maxIter)):
+            if callback is not None:
+                callback(r * maxIter + l, len(values) * maxIter)
+            if converge:
+                changed = sweepField(row, indptr, indices, thresh, np.flatnonzero(row < thresh))
+            else:
+                changed = sweepField(row, indptr, indices, thresh)
+            usedIter = max(usedIter, l + 1)
+            if converge and not changed.any():
+                break
+    return values, usedIter
+
+
+def connectedComponents(indptr, indices):
+
+    """
+    Labels the connected components of a CSR graph (labels follow first member)
+    """
+
+    n_feats = len(indptr) - 1
+    labels = np.full(n_feats, -1, dtype = np.int64)
+    n_comps = 0
+    for start in list(range(0, n_feats)):
+        if labels[start] >= 0:
+            continue
+        labels[start] = n_comps
+        stack = [start]
+        while stack:
+            i = stack.pop()
+            for j in indices[indptr[i]:indptr[i + 1]].tolist():
+                if labels[j] < 0:
+                    labels[j] = n_comps
+                    stack.append(j)
+        n_comps += 1
+    return labels
+
+
+def subgraph(indptr, indices, members):
+
+    """
+    Extracts the CSR graph induced by a sorted array of closed member positions
+    """
+
+    local = np.full(len(indptr) - 1, -1, dtype = np.int64)
+    local[members] = np.arange(len(members))
+    counts = indptr[members + 1] - indptr[members]
+    subIndptr = np.zeros(len(members) + 1, dtype = np.int64)
+    np.cumsum(counts, out = subIndptr[1:])
+    subIndices = np.concatenate([indices[indptr[i]:indptr[i + 1]] for i in members.tolist()] or
+                                [np.zeros(0, dtype = np.int64)])
+    return subIndptr, local[subIndices]
+
+
+def componentChunks(labels, n_chunks):
+
+    """
+    Packs whole components into roughly equal sized, sorted member arrays
+    """
+
+    order = np.argsort(labels, kind = 'stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    comps = np.split(order, bounds)
+    target = max(1, int(np.ceil(len(labels) / float(max(1, n_chunks)))))
+
+    chunks = []
+    current = []
+    size = 0
+    for comp in comps:
+        current.append(comp)
+        size += len(comp)
+        if size >= target:
+            chunks.append(np.sort(np.concatenate(current)))
+            current = []
+            size = 0
+    if current:
+        chunks.append(np.sort(np.concatenate(current)))
+    return chunks
+
+
+def smoothUnit(unit):
+
+    # process pool entry point for one (field, component chunk) work unit
+    values, indptr, indices, thresh, maxIter, converge = unit
+    newValues, usedIter = abideMinCases(values, indptr, indices, thresh, maxIter, converge)
+    return newValues[0], usedIter
+
+
+def abideMinCasesParallel(values, indptr, indices, thresh, maxIter, converge = False, processes = 0, callback = None):
+
+    """
+    Same as abideMinCases, spread over (field, connected component) work units
+
+    Components never interact and fields are smoothed independently, so every
+    unit is processed in the serial feature order and the merged result is
+    identical to the serial run. The optional callback(done, total) is called
+    whenever a work unit has been merged.
+    """
+
+    values = np.array(values, dtype = np.float64, ndmin = 2)
+    processes = resolveProcesses(processes)
+    labels = connectedComponents(indptr, indices)
+    chunks = componentChunks(labels, processes * 4)
+    graphs = [subgraph(indptr, indices, members) for members in chunks]
+
+    units = []
+    targets = []
+    for v in list(range(0, values.shape[0])):
+        for c in list(range(0, len(chunks))):
+            subIndptr, subIndices = graphs[c]
+            units.append((values[v, chunks[c]], subIndptr, subIndices, thresh, maxIter, converge))
+            targets.append((v, chunks[c]))
+
+    # merge results in submission order
+    usedIter = 0
+    with createProcessPool(processes) as pool:
+        results = pool.map(smoothUnit, units)
+        for u, ((v, members), (newValues, unitIter)) in enumerate(zip(targets, results)):
+            values[v, members] = newValues
+            usedIter = max(usedIter, unitIter)
+            if callback is not None:
+                callback(u + 1, len(units))
+    return values, usedIter
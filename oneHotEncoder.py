@@ -16,9 +16,37 @@ from qgis.core import (QgsProcessing,
                        QgsFeature,
                        QgsVectorLayer,
                        QgsVectorFileWriter,
-                       QgsProject)
-from qgis.utils import iface
+                       QgsProcessingException,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterNumber)
+from contextlib import ExitStack
+import os
 import pandas as pd
+import sys
+
+# make the helper modules next to this script importable
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+if scriptDir not in sys.path:
+    sys.path.append(scriptDir)
+
+from layerWriter import EncodedLayerWriter
+from oneHotEncoderCore import (collectCategories,
+                               fitVocabulary,
+                               loadVocabulary,
+                               oneHotDense,
+                               oneHotHashed,
+                               oneHotSparse,
+                               saveVocabulary,
+                               sparseTriples,
+                               vocabularyLookup,
+                               writeSparseNpz)
+from processingMonitor import ProcessingMonitor
+from tableLoader import (iterAttributeBatches,
+                         loadAttributeTable)
+from tableWriter import (FILE_FILTER,
+                         TableWriter,
+                         writeTable)
 
 
 class oneHotEncoder(QgsProcessingAlgorithm):
@@ -29,7 +57,14 @@ class oneHotEncoder(QgsProcessingAlgorithm):
 
     inputTab = 'inputTab'
     colsEnc = 'colsEnc'
+    mode = 'mode'
+    buckets = 'buckets'
+    chunkSize = 'chunkSize'
+    vocabIn = 'vocabIn'
+    vocabOut = 'vocabOut'
     OUTPUT = 'output'
+    encodedLayer = 'encodedLayer'
+    stageReport = 'stageReport'
     
 
     def initAlgorithm(self, config = None):
@@ -54,12 +89,88 @@ class oneHotEncoder(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.mode,
+                self.tr('Encoding mode'),
+                [self.tr('Dense (one uint8 column per value)'),
+                 self.tr('Sparse (row, field, category triples; .npz for coordinate arrays)'),
+                 self.tr('Hashed (fixed number of signed bucket columns, no vocabulary)')],
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.buckets,
+                self.tr('Number of hash buckets (hashed mode only)'),
+                QgsProcessingParameterNumber.Integer,
+                1024,
+                False,
+                1
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.chunkSize,
+                self.tr('Rows per batch for streaming (0 = load the whole table at once)'),
+                QgsProcessingParameterNumber.Integer,
+                0,
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.vocabIn,
+                self.tr('Existing vocabulary to encode with (transform)'),
+                QgsProcessingParameterFile.File,
+                'json',
+                None,
+                True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.vocabOut,
+                self.tr('Save vocabulary (fit)'),
+                fileFilter = '*.json',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
        
         self.addParameter(
             QgsProcessingParameterFileDestination(
                 self.OUTPUT,
                 self.tr('Output table'),
-                fileFilter = 'csv'
+                fileFilter = FILE_FILTER + ';;Sparse coordinate arrays (*.npz)',
+                optional = True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.encodedLayer,
+                self.tr('Encoded copy of the input layer (geometry and encoded fields)'),
+                fileFilter = 'GeoPackage (*.gpkg)',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.stageReport,
+                self.tr('Stage timing report'),
+                fileFilter = '*.json',
+                optional = True,
+                createByDefault = False
             )
         )
         
@@ -69,55 +180,120 @@ class oneHotEncoder(QgsProcessingAlgorithm):
         # get inputs
         inputTab = self.parameterAsVectorLayer(parameters, self.inputTab, context)
         colsEnc = self.parameterAsFields(parameters, self.colsEnc, context)
+        mode = self.parameterAsEnum(parameters, self.mode, context)
+        sparse = mode == 1
+        hashed = mode == 2
+        buckets = self.parameterAsInt(parameters, self.buckets, context)
+        chunkSize = self.parameterAsInt(parameters, self.chunkSize, context)
+        vocabIn = self.parameterAsFile(parameters, self.vocabIn, context)
+        vocabOut = self.parameterAsFileOutput(parameters, self.vocabOut, context)
         outTab = self.parameterAsString(parameters, self.OUTPUT, context)
+        outLayer = self.parameterAsFileOutput(parameters, self.encodedLayer, context)
+        reportPath = self.parameterAsFileOutput(parameters, self.stageReport, context)
+        
+        # set up progress reporting and stage timing
+        monitor = ProcessingMonitor(feedback, self.name(), 3)
         
         
                   
+        if not outTab and not outLayer:
+            raise QgsProcessingException('Choose an output table, an encoded layer copy or both')
+        if sparse and outLayer:
+            raise QgsProcessingException('Sparse indicators cannot be added to a layer copy, use dense or hashed mode')
+        
+        # hashing needs neither a vocabulary nor a pass to discover categories
+        if hashed and (vocabIn or vocabOut):
+            raise QgsProcessingException('Vocabularies are not used in hashed mode, leave both vocabulary parameters empty')
+        
+        # transform with an existing vocabulary, which skips category discovery
+        categories = None
+        other = False
+        if vocabIn:
+            try:
+                vocabulary = loadVocabulary(vocabIn)
+                categories = vocabularyLookup(vocabulary, colsEnc)
+            except (OSError, ValueError) as e:
+                raise QgsProcessingException(str(e))
+            other = vocabulary['other']
+            if vocabOut:
+                saveVocabulary(vocabOut, vocabulary)
+        
+        def fit(found):
+            
+            # fix the discovered categories in a stable order and save them
+            vocabulary = fitVocabulary(found)
+            saveVocabulary(vocabOut, vocabulary)
+            return vocabularyLookup(vocabulary, colsEnc), vocabulary['other']
+        
+        
+        # stream the table in batches with bounded memory
+        if chunkSize > 0:
+            if sparse and outTab.lower().endswith('.npz'):
+                raise QgsProcessingException('Sparse coordinate arrays (.npz) cannot be written in streaming mode, use a table output')
+            
+            # first pass over the encoded columns only to collect their values
+            if categories is None and not hashed:
+                with monitor.stage('collect categories') as stage:
+                    categories = collectCategories(iterAttributeBatches(inputTab, colsEnc, chunkSize, monitor), colsEnc)
+                    if vocabOut:
+                        categories, other = fit(categories)
+                    stage.features = inputTab.featureCount()
+            
+            # second pass encoding each batch and appending it to the outputs
+            with monitor.stage('encode and write') as stage, ExitStack() as outputs:
+                writer = outputs.enter_context(TableWriter(outTab)) if outTab else None
+                layerWriter = outputs.enter_context(EncodedLayerWriter(inputTab, outLayer)) if outLayer else None
+                for batch in iterAttributeBatches(inputTab, colsEnc if sparse or not outTab else None, chunkSize, monitor):
+                    if sparse:
+                        rows, colIdx, columns = oneHotSparse(batch, colsEnc, categories, stage.features, other)
+                        writer.write(sparseTriples(rows, colIdx, columns))
+                    else:
+                        encoded = oneHotHashed(batch, colsEnc, buckets) if hashed else oneHotDense(batch, colsEnc, categories, other)
+                        if writer is not None:
+                            writer.write(pd.concat([batch, encoded], axis = 1))
+                        if layerWriter is not None:
+                            layerWriter.write(encoded)
+                    stage.features += len(batch)
+            monitor.writeReport(reportPath)
+            return {self.OUTPUT: outTab, self.encodedLayer: outLayer}
+        
+        
         # import qgis attribute table as pandas data frame
-        def qgsTabToDataFrame(inputTab):
-            allAtts = inputTab.dataProvider().fields().names()
-            atts = pd.DataFrame([], columns = allAtts)
-            i = 0
-            for feature in inputTab.getFeatures():
-                atts.loc[i] = feature.attributes()
-                i += 1
-            return atts
-        
-        atts = qgsTabToDataFrame(inputTab)
+        with monitor.stage('load') as stage:
+            # sparse output and the layer copy only reference the encoded columns
+            atts = loadAttributeTable(inputTab, colsEnc if sparse or not outTab else None, monitor)
+            stage.features = len(atts)
             
         
         # perform one hot encoding
-        def oneHotEncoding(inDataFrame, cols):
-        
-            # iterate over each column to be one hot encoded
-            for c in cols:
-                
-                # get column as series
-                dat = inDataFrame[c]
-                
-                # get unique values
-                unis = dat.unique()
-                
-                # iterate over each unique value
-                for u in unis:
-                    
-                    # create new series for this unique value and hot code this series
-                    inDataFrame[u] = 0
-                    cond = inDataFrame[c] == u
-                    inDataFrame.loc[cond, u] = 1
-                    
-            return inDataFrame
-        
-        outDat = oneHotEncoding(atts, colsEnc)
+        with monitor.stage('encode') as stage:
+            if categories is None and vocabOut:
+                categories, other = fit(collectCategories([atts], colsEnc))
+            if sparse:
+                rows, colIdx, columns = oneHotSparse(atts, colsEnc, categories, 0, other)
+            else:
+                encoded = oneHotHashed(atts, colsEnc, buckets) if hashed else oneHotDense(atts, colsEnc, categories, other)
+            stage.features = len(atts)
                 
         
-        # write encoded table to file
-        outDat.to_csv(outTab, index = False, encoding = 'ANSI')
+        # write encoded table to file and the encoded fields to the layer copy
+        with monitor.stage('write') as stage:
+            if sparse and outTab.lower().endswith('.npz'):
+                writeSparseNpz(outTab, rows, colIdx, columns, len(atts))
+            elif sparse:
+                writeTable(outTab, sparseTriples(rows, colIdx, columns))
+            elif outTab:
+                writeTable(outTab, pd.concat([atts, encoded], axis = 1))
+            if outLayer:
+                with EncodedLayerWriter(inputTab, outLayer) as layerWriter:
+                    layerWriter.write(encoded)
+            stage.features = len(atts)
+        monitor.writeReport(reportPath)
         
         
             
 
-        return {self.OUTPUT: inputTab}
+        return {self.OUTPUT: outTab, self.encodedLayer: outLayer}
 
     def name(self):
         return 'oneHotEncoder'
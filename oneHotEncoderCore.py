@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+One hot encoding used by oneHotEncoder.
+
+Every column is reduced to integer category codes in one factorize pass.
+From the codes the indicators are either expanded into dense uint8 columns or
+kept as sparse (row, column) coordinates, which need two integers per row and
+encoded column instead of one byte per row and category.
+
+A vocabulary fixes the categories of every column in a stable (sorted) order
+plus an optional "other" bucket for values not seen while fitting, so tables
+encoded with the same vocabulary always share one schema.
+
+For columns with too many distinct values the hashing trick maps every
+"column=value" key onto a fixed number of bucket columns instead, with a
+hash-derived sign of +1 or -1 so that collisions tend to cancel out rather
+than pile up. It needs no vocabulary and encodes every batch independently.
+"""
+
+import datetime
+import json
+import numpy as np
+import pandas as pd
+
+
+VOCABULARY_VERSION = 1
+HASH_PREFIX = 'hash_'
+
+
+def otherLabel(col):
+    return str(col) + '_other'
+
+
+def categoryCodes(inDataFrame, cols, categories = None, other = False):
+
+    """
+    Returns per column the category codes (-1 for NULL) and the categories
+
+    Categories keep their order of appearance, as in the original encoder.
+    With a dict of known categories per column (lists or prebuilt pd.Index
+    lookups) the codes refer to those instead. Values missing from them get
+    -1 as well, or the code of an extra "other" category if other is set.
+    """
+
+    encoded = []
+    for c in cols:
+        if categories is None:
+            codes, unis = pd.factorize(inDataFrame[c], sort = False)
+            unis = list(unis)
+        else:
+            lookup = categories[c] if isinstance(categories[c], pd.Index) else pd.Index(categories[c])
+            codes = lookup.get_indexer(inDataFrame[c])
+            unis = list(lookup)
+            if other:
+                codes[(codes < 0) & inDataFrame[c].notna().to_numpy()] = len(unis)
+                unis.append(otherLabel(c))
+        encoded.append((c, codes, unis))
+    return encoded
+
+
+def collectCategories(batches, cols):
+
+    """
+    Collects the distinct values per column over a stream of data frames
+
+    The result equals the categories found on the complete table.
+    """
+
+    seen = {c: {} for c in cols}
+    for batch in batches:
+        for c in cols:
+            known = seen[c]
+            for u in pd.factorize(batch[c], sort = False)[1]:
+                if u not in known:
+                    known[u] = len(known)
+    return {c: list(seen[c]) for c in cols}
+
+
+def oneHotDense(inDataFrame, cols, categories = None, other = False):
+
+    """
+    Returns the indicator columns as a data frame of uint8 columns named by value
+    """
+
+    frames = []
+    for c, codes, unis in categoryCodes(inDataFrame, cols, categories, other):
+        dense = np.zeros((len(codes), len(unis)), dtype = np.uint8)
+        valid = codes >= 0
+        dense[np.flatnonzero(valid), codes[valid]] = 1
+        frames.append(pd.DataFrame(dense, columns = unis, index = inDataFrame.index))
+    if not frames:
+        return pd.DataFrame(index = inDataFrame.index)
+    return pd.concat(frames, axis = 1)
+
+
+def oneHotSparse(inDataFrame, cols, categories = None, rowOffset = 0, other = False):
+
+    """
+    Returns the indicators as COO coordinates: rows, column indices and columns
+
+    Rows are the 0-based positions of the records in the input table (shifted
+    by rowOffset for later batches), columns are (field, category) pairs.
+    """
+
+    rows = []
+    colIdx = []
+    columns = []
+    for c, codes, unis in categoryCodes(inDataFrame, cols, categories, other):
+        valid = np.flatnonzero(codes >= 0)
+        rows.append(valid.astype(np.int64) + rowOffset)
+        colIdx.append(codes[valid].astype(np.int64) + len(columns))
+        columns.extend((c, u) for u in unis)
+    if not columns:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), []
+    return np.concatenate(rows), np.concatenate(colIdx), columns
+
+
+def sparseTriples(rows, colIdx, columns):
+
+    """
+    Returns sparse indicators in long format, one (row, field, category) line each
+    """
+
+    fields = np.array([str(f) for f, u in columns], dtype = object)
+    categories = np.array([str(u) for f, u in columns], dtype = object)
+    order = np.lexsort((colIdx, rows))
+    return pd.DataFrame({'row': rows[order],
+                         'field': fields[colIdx[order]],
+                         'category': categories[colIdx[order]]})
+
+
+def writeSparseNpz(path, rows, colIdx, columns, n_rows):
+
+    """
+    Writes sparse indicators as compressed coordinate arrays
+    """
+
+    np.savez_compressed(path, row = rows, col = colIdx, shape = np.array([n_rows, len(columns)]),
+                        fields = np.array([str(f) for f, u in columns]),
+                        categories = np.array([str(u) for f, u in columns]))
+    return path
+
+
+def sortKey(val):
+
+    # numbers before text, each in natural order
+    if isinstance(val, (int, float, np.bool_, np.integer, np.floating)):
+        return (0, float(val), '')
+    return (1, 0.0, str(val))
+
+
+def isDateValue(val):
+    return isinstance(val, (datetime.date, np.datetime64))
+
+
+def toJsonValue(val):
+    if isinstance(val, np.datetime64):
+        val = pd.Timestamp(val)
+    if isinstance(val, datetime.date):
+        return val.isoformat()
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, (str, int, float, bool)):
+        return val
+    return str(val)
+
+
+def fitVocabulary(categories, other = True):
+
+    """
+    Builds a vocabulary from collected categories with a stable sorted order
+
+    Date and datetime categories are stored as ISO strings, the columns holding
+    them are listed under "dates" so that they are parsed back on load.
+    """
+
+    return {'version': VOCABULARY_VERSION,
+            'other': bool(other),
+            'columns': {str(c): [toJsonValue(u) for u in sorted(unis, key = sortKey)]
+                        for c, unis in categories.items()},
+            'dates': [str(c) for c, unis in categories.items() if unis and all(isDateValue(u) for u in unis)]}
+
+
+def saveVocabulary(path, vocabulary):
+    with open(path, 'w', encoding = 'utf-8') as f:
+        json.dump(vocabulary, f, ensure_ascii = False, indent = 1)
+    return path
+
+
+def loadVocabulary(path):
+    with open(path, encoding = 'utf-8') as f:
+        vocabulary = json.load(f)
+    if vocabulary.get('version') != VOCABULARY_VERSION or 'columns' not in vocabulary:
+        raise ValueError('Not a supported vocabulary file: ' + path)
+    return vocabulary
+
+
+def vocabularyLookup(vocabulary, cols):
+
+    """
+    Prebuilds the category-to-index lookup of every encoded column
+    """
+
+    missing = [c for c in cols if c not in vocabulary['columns']]
+    if missing:
+        raise ValueError('Vocabulary has no categories for column(s): ' + ', '.join(missing))
+    dates = set(vocabulary.get('dates', []))
+    return {c: pd.DatetimeIndex([pd.Timestamp(v) for v in vocabulary['columns'][c]]) if c in dates
+            else pd.Index(vocabulary['columns'][c]) for c in cols}
+
+
+def hashedColumns(buckets, prefix = HASH_PREFIX):
+    return [prefix + str(k) for k in list(range(0, buckets))]
+
+
+def hashBuckets(col, unis, buckets):
+
+    """
+    Returns bucket and sign of every distinct value of a column
+
+    The hash of pandas is keyed with a fixed key, so it is stable across
+    runs, processes and batches. Values are hashed by their text so that the
+    same value always lands in the same bucket regardless of the column dtype.
+    """
+
+    keys = np.array([str(col) + '=' + str(u) for u in unis], dtype = object)
+    h = pd.util.hash_array(keys, categorize = False)
+    bucket = (h % np.uint64(buckets)).astype(np.int64)
+    sign = np.where(h >> np.uint64(63), -1, 1).astype(np.int8)
+    return bucket, sign
+
+
+def oneHotHashed(inDataFrame, cols, buckets, prefix = HASH_PREFIX):
+
+    """
+    Returns the signed hashed indicators as a data frame of bucket columns
+
+    Every non-NULL value adds its sign to its bucket, so a cell holds the sum
+    over the encoded columns whose values share that bucket.
+    """
+
+    # int8 cannot overflow as long as fewer than 128 columns add to one cell
+    dtype = np.int8 if len(cols) < 128 else np.int32
+    out = np.zeros((len(inDataFrame), buckets), dtype = dtype)
+    for c in cols:
+        codes, unis = pd.factorize(inDataFrame[c], sort = False)
+        if len(unis) == 0:
+            continue
+        bucket, sign = hashBuckets(c, unis, buckets)
+        valid = np.flatnonzero(codes >= 0)
+        # each row gets at most one entry per column, so no index repeats here
+        out[valid, bucket[codes[valid]]] += sign[codes[valid]]
+    return pd.DataFrame(out, columns = hashedColumns(buckets, prefix), index = inDataFrame.index)
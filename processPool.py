@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""
+Process pool helpers shared by the tools that can spread work over cores.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
+
+
+def resolveProcesses(processes):
+
+    """
+    Translates the user setting into a worker count (0 means all cores)
+    """
+
+    processes = int(processes)
+    if processes <= 0:
+        processes = os.cpu_count() or 1
+    return processes
+
+
+def createProcessPool(processes, initializer = None, initargs = ()):
+
+    """
+    Creates a process pool which also works when started from within QGIS
+
+    initializer(*initargs) runs once in every worker when it starts.
+    """
+
+    # QGIS on Windows reports its own executable, so spawn the bundled interpreter instead
+    if sys.platform == 'win32':
+        mpContext = multiprocessing.get_context('spawn')
+        mpContext.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    else:
+        mpContext = multiprocessing.get_context()
+    return ProcessPoolExecutor(max_workers = resolveProcesses(processes), mp_context = mpContext,
+                               initializer = initializer, initargs = initargs)
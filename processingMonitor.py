@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+Progress, cancellation and per-stage timing shared by all tools.
+
+A run is split into named stages. Each stage owns one step of a
+QgsProcessingMultiStepFeedback, so progress reported inside a stage (or by a
+child algorithm receiving monitor.feedback) moves the overall progress bar.
+Progress updates are throttled and double as cancellation checks.
+"""
+
+from qgis.core import (QgsMessageLog,
+                       QgsProcessingException,
+                       QgsProcessingFeedback,
+                       QgsProcessingMultiStepFeedback)
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peakMemoryMB():
+
+    """
+    Returns the peak resident memory of this process in MB (None if unknown)
+    """
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+        if sys.platform == 'darwin':
+            return peak / 1024.0 ** 2
+        return peak / 1024.0
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) / 1024.0 ** 2
+
+
+class Stage(object):
+
+    """
+    Timing record of one stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.features = 0
+        self.seconds = 0.0
+        self.peakMemoryMB = None
+        self.memoryGrowthMB = None
+
+    def asDict(self):
+        return {'name': self.name,
+                'features': self.features,
+                'seconds': round(self.seconds, 6),
+                'peakMemoryMB': self.peakMemoryMB,
+                'memoryGrowthMB': self.memoryGrowthMB}
+
+
+class _StageContext(object):
+
+    def __init__(self, monitor, stage):
+        self.monitor = monitor
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.startMemory = peakMemoryMB()
+        return self.stage
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stage.seconds = time.perf_counter() - self.start
+        self.stage.peakMemoryMB = peakMemoryMB()
+        if self.startMemory is not None and self.stage.peakMemoryMB is not None:
+            self.stage.memoryGrowthMB = self.stage.peakMemoryMB - self.startMemory
+        self.monitor.feedback.setProgress(100)
+        return False
+
+
+class ProcessingMonitor(object):
+
+    """
+    Throttled progress, cancellation checks and a per-stage timing report
+    """
+
+    def __init__(self, feedback, algorithm, steps = 1, minInterval = 0.2):
+        self.parentFeedback = feedback
+        self.algorithm = algorithm
+        self.steps = max(1, steps)
+        self.minInterval = minInterval
+        self.stages = []
+        self.notes = {}
+        self.started = time.perf_counter()
+        self.lastUpdate = 0.0
+        self.lastPercent = -1
+        if feedback is None:
+            feedback = QgsProcessingFeedback()
+        self.feedback = QgsProcessingMultiStepFeedback(self.steps, feedback)
+
+    def stage(self, name):
+
+        """
+        Context manager timing one stage, yields its Stage record
+        """
+
+        self.checkCanceled()
+        self.feedback.setCurrentStep(min(len(self.stages), self.steps - 1))
+        stage = Stage(name)
+        self.stages.append(stage)
+        self.lastPercent = -1
+        QgsMessageLog.logMessage(self.algorithm + ': ' + name + '...', 'User notification', 0)
+        return _StageContext(self, stage)
+
+    def note(self, key, value):
+
+        """
+        Adds a named result (e.g. an error summary) to the report
+        """
+
+        self.notes[key] = value
+
+    def checkCanceled(self):
+        if self.feedback.isCanceled():
+            raise QgsProcessingException('Canceled by user')
+
+    def progress(self, done, total):
+
+        """
+        Reports progress within the current stage, at most every minInterval seconds
+        """
+
+        now = time.perf_counter()
+        if now - self.lastUpdate < self.minInterval:
+            return
+        self.lastUpdate = now
+        self.checkCanceled()
+        percent = int(100.0 * done / total) if total else 100
+        if percent != self.lastPercent:
+            self.lastPercent = percent
+            self.feedback.setProgress(percent)
+
+    def report(self):
+        report = {'algorithm': self.algorithm,
+                  'seconds': round(time.perf_counter() - self.started, 6),
+                  'peakMemoryMB': peakMemoryMB(),
+                  'stages': [s.asDict() for s in self.stages]}
+        if self.notes:
+            report['notes'] = self.notes
+        return report
+
+    def writeReport(self, path):
+
+        """
+        Logs the stage timings and optionally writes them to a JSON file
+        """
+
+        for s in self.stages:
+            QgsMessageLog.logMessage('%s: %s took %.3f s (%d features)' % (self.algorithm, s.name, s.seconds, s.features),
+                                     'User notification', 0)
+        if path:
+            with open(path, 'w', encoding = 'utf-8') as f:
+                json.dump(self.report(), f, indent = 2)
+
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mergeable streaming quantile sketch used for automatic binning.
+
+Values are kept in a stack of compactors: level h holds items that each stand
+for 2 ** h input values. Whenever a level grows beyond its capacity it is
+sorted and every other item (starting at a random offset) is promoted to the
+next level. Memory therefore stays around capacity * log2(n / capacity) items
+while the rank error stays within a few multiples of 1 / capacity. Two sketches
+of different batches or processes can be merged level by level.
+
+Next to the compactors the sketch tracks the exact count, minimum and maximum
+and a uniform bottom-k sample (the values with the smallest random keys), which
+feeds methods such as natural breaks that need actual data points.
+The module does not depend on QGIS.
+"""
+
+import numpy as np
+
+
+class QuantileSketch(object):
+
+    """
+    Approximate quantiles and a uniform sample of a stream of numbers
+    """
+
+    def __init__(self, capacity = 2048, sampleSize = 2000, seed = 0):
+        self.capacity = max(2, int(capacity))
+        self.sampleSize = max(1, int(sampleSize))
+        self.rng = np.random.default_rng(seed)
+        self.levels = [np.zeros(0, dtype = np.float64)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sampleValues = np.zeros(0, dtype = np.float64)
+        self.sampleKeys = np.zeros(0, dtype = np.float64)
+
+    def update(self, values):
+
+        """
+        Adds a batch of values, NaN is ignored
+        """
+
+        values = np.asarray(values, dtype = np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        self.addSample(values, self.rng.random(len(values)))
+        return self
+
+    def merge(self, other):
+
+        """
+        Adds all values summarised by another sketch
+        """
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.zeros(0, dtype = np.float64))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+        self.addSample(other.sampleValues, other.sampleKeys)
+        return self
+
+    def compress(self):
+
+        # promote every other item of overfull levels, keeping an odd leftover in place
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if len(items) > self.capacity:
+                items = np.sort(items)
+                keep = items[len(items) - len(items) % 2:]
+                promoted = items[int(self.rng.integers(0, 2)):len(items) - len(items) % 2:2]
+                self.levels[h] = keep
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0, dtype = np.float64))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def addSample(self, values, keys):
+
+        # keep the values with the smallest random keys
+        values = np.concatenate([self.sampleValues, values])
+        keys = np.concatenate([self.sampleKeys, keys])
+        if len(keys) > self.sampleSize:
+            keep = np.argpartition(keys, self.sampleSize - 1)[:self.sampleSize]
+            values = values[keep]
+            keys = keys[keep]
+        self.sampleValues = values
+        self.sampleKeys = keys
+
+    def quantiles(self, qs):
+
+        """
+        Returns the approximate values at the given ranks (0 = min, 1 = max)
+        """
+
+        qs = np.asarray(qs, dtype = np.float64)
+        if self.count == 0:
+            return np.full(qs.shape, np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(l), 2.0 ** h) for h, l in enumerate(self.levels)])
+        order = np.argsort(items, kind = 'stable')
+        items = items[order]
+        cumWeights = np.cumsum(weights[order])
+        pos = np.searchsorted(cumWeights, qs * cumWeights[-1], side = 'left')
+        result = items[np.clip(pos, 0, len(items) - 1)]
+        # the extremes are known exactly
+        result[qs <= 0] = self.min
+        result[qs >= 1] = self.max
+        return result
+
+    def sample(self):
+
+        """
+        Returns the uniform sample in ascending order
+        """
+
+        return np.sort(self.sampleValues)
@@ -1,19 +1,42 @@
 # -*- coding: utf-8 -*-
 
-import processing
 from PyQt5.QtCore import (QCoreApplication, QVariant)
 from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
+                       QgsProcessingParameterBoolean,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterField,
                        QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingException,
                        QgsMessageLog,
-                       QgsVectorFileWriter,
-                       QgsExpression,
-                       QgsField,
-                       QgsProject,
-                       QgsExpressionContext,
-                       QgsExpressionContextScope)
+                       QgsProcessingContext,
+                       QgsField)
+import os
+import sys
+
+# make the helper modules next to this script importable
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+if scriptDir not in sys.path:
+    sys.path.append(scriptDir)
+
+from arealEngine import (aggregateWeighted,
+                         saveRunState,
+                         saveWeightMatrix)
+from arealOverlay import (buildOverlay,
+                          cachedOverlay,
+                          loadGeometries,
+                          loadValues)
+from arealRaster import rasterOverlay
+from geometryPrep import GeometryPrep
+from gpkgWriter import writeLayer
+from processingMonitor import ProcessingMonitor
+from shiftState import (incrementalOverlay,
+                        layerHashes,
+                        loadState,
+                        outputFids,
+                        statePath,
+                        updateOutput)
 
 
 class shiftShapes(QgsProcessingAlgorithm):
@@ -25,7 +48,17 @@ class shiftShapes(QgsProcessingAlgorithm):
     inShape = 'inShape'
     outShape = 'outShape'
     colApply = 'colApply'
+    cellSize = 'cellSize'
+    tileSize = 'tileSize'
+    processes = 'processes'
+    useCache = 'useCache'
+    incremental = 'incremental'
+    snapGrid = 'snapGrid'
+    simplifyTolerance = 'simplifyTolerance'
+    minArea = 'minArea'
     OUTPUT = 'output'
+    weightMatrix = 'weightMatrix'
+    stageReport = 'stageReport'
     
 
     def initAlgorithm(self, config = None):
@@ -58,6 +91,88 @@ class shiftShapes(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.cellSize,
+                self.tr('Zellgröße für die genäherte Rasterverschneidung in Einheiten des Zielsystems (0 = exakt)'),
+                QgsProcessingParameterNumber.Double,
+                0,
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.tileSize,
+                self.tr('Kachelgröße für die parallele Verschneidung in Einheiten des Zielsystems (0 = keine Kacheln)'),
+                QgsProcessingParameterNumber.Double,
+                0,
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.processes,
+                self.tr('Anzahl paralleler Prozesse (0 = alle Prozessorkerne)'),
+                QgsProcessingParameterNumber.Integer,
+                1,
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.useCache,
+                self.tr('Flächengewichte neben dem Eingabedatensatz zwischenspeichern'),
+                True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.incremental,
+                self.tr('Nur geänderte Flächen neu berechnen und die bestehende Ausgabe aktualisieren'),
+                False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.snapGrid,
+                self.tr('Stützpunkte auf ein Raster dieser Weite einrasten (0 = aus)'),
+                QgsProcessingParameterNumber.Double,
+                0,
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.simplifyTolerance,
+                self.tr('Toleranz für die Vereinfachung der Grenzen (0 = aus)'),
+                QgsProcessingParameterNumber.Double,
+                0,
+                False,
+                0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.minArea,
+                self.tr('Mindestfläche für Teilflächen und Verschneidungsfragmente (0 = aus)'),
+                QgsProcessingParameterNumber.Double,
+                0,
+                False,
+                0
+            )
+        )
+        
         self.addParameter(
             QgsProcessingParameterFileDestination(
                 self.OUTPUT,
@@ -66,6 +181,26 @@ class shiftShapes(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.weightMatrix,
+                self.tr('Gewichtsmatrix (Quelle, Ziel, Gewicht)'),
+                fileFilter = '*.npz',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                self.stageReport,
+                self.tr('Laufzeitbericht'),
+                fileFilter = '*.json',
+                optional = True,
+                createByDefault = False
+            )
+        )
+        
         
     def processAlgorithm(self, parameters, context, feedback):
         
@@ -73,142 +208,136 @@ class shiftShapes(QgsProcessingAlgorithm):
         inShape = self.parameterAsVectorLayer(parameters, self.inShape, context)
         outShape = self.parameterAsVectorLayer(parameters, self.outShape, context)
         colApply = self.parameterAsFields(parameters, self.colApply, context)
+        cellSize = self.parameterAsDouble(parameters, self.cellSize, context)
+        tileSize = self.parameterAsDouble(parameters, self.tileSize, context)
+        processes = self.parameterAsInt(parameters, self.processes, context)
+        useCache = self.parameterAsBool(parameters, self.useCache, context)
+        incremental = self.parameterAsBool(parameters, self.incremental, context)
+        prep = GeometryPrep(self.parameterAsDouble(parameters, self.snapGrid, context),
+                            self.parameterAsDouble(parameters, self.simplifyTolerance, context),
+                            self.parameterAsDouble(parameters, self.minArea, context))
         outPath = self.parameterAsString(parameters, self.OUTPUT, context)
+        weightPath = self.parameterAsFileOutput(parameters, self.weightMatrix, context)
+        reportPath = self.parameterAsFileOutput(parameters, self.stageReport, context)
+        
+        # set up progress reporting and stage timing
+        monitor = ProcessingMonitor(feedback, self.name(), 4)
         
 
+        if incremental and cellSize > 0:
+            raise QgsProcessingException('The incremental mode needs the exact overlay, set the cell size to 0')
+        
         # get field indices of interest
-        QgsMessageLog.logMessage('Getting field names and indices...', 'User notification', 0)
+        fieldIdx = []
         fieldIdx_names = []
-        fieldIdx_temp_names = []
-        fieldIdx_temp_names_sum = []
         fieldNames = inShape.fields().names()
         for f in list(range(0, len(fieldNames))):
             if fieldNames[f] in colApply:
+                fieldIdx.append(f)
                 fieldIdx_names.append(fieldNames[f])
-                fieldIdx_temp_names.append(fieldNames[f] + '_temp')
-                fieldIdx_temp_names_sum.append(fieldNames[f] + '_temp_sum')
                
         
-        # calculating area of source polygons
-        QgsMessageLog.logMessage('Calculating area of source polygons...', 'User notification', 0)
-        parameters = {'FIELD_LENGTH' : 10,
-                      'FIELD_NAME' : 'ShaShif_AT',
-                      'FIELD_PRECISION' : 10,
-                      'FIELD_TYPE' : 1,
-                      'FORMULA' : 'value = $geom.area()',
-                      'GLOBAL' : '',
-                      'INPUT' : outShape,
-                      'OUTPUT' : 'memory:'}
-        outShape_area = processing.run('qgis:advancedpythonfieldcalculator', parameters)['OUTPUT'] 
-        
-        
-        # perform union of source and target polygons
-        QgsMessageLog.logMessage('Performing union of source and target polygons...', 'User notification', 0)
-        parameters = {'INPUT' : inShape,
-                      'OVERLAY' : outShape_area,
-                      'OUTPUT' : 'memory:'}
-        unionShape = processing.run('native:union', parameters)['OUTPUT']
-        
-        
-        # calculate union areas
-        QgsMessageLog.logMessage('Calculating union areas...', 'User notification', 0)
-        parameters = {'FIELD_LENGTH' : 10,
-                      'FIELD_NAME' : 'ShaShif_Ai',
-                      'FIELD_PRECISION' : 10,
-                      'FIELD_TYPE' : 1,
-                      'FORMULA' : 'value = $geom.area()',
-                      'GLOBAL' : '',
-                      'INPUT' : unionShape,
-                      'OUTPUT' : 'memory:'}
-        unionShape_area = processing.run('qgis:advancedpythonfieldcalculator', parameters)['OUTPUT']
-        
-        
-                
-        # define function for simple field calculation
-        def calcField(lyr, field_name, expres):
-            lyr.dataProvider().addAttributes([ QgsField(field_name, QVariant.Double)])
-            expression = QgsExpression(expres)
-            context = QgsExpressionContext()
-            scope = QgsExpressionContextScope()
-            context.appendScope(scope)
-            lyr.startEditing()
-            for feature in lyr.getFeatures():
-                scope.setFeature(feature)
-                feature[field_name] = expression.evaluate(context)
-                lyr.updateFeature(feature)
-
-            lyr.commitChanges()
-        
-        # iterate over each field to be processed
-        QgsMessageLog.logMessage('Calculating new field values...', 'User notification', 0)
-        
-        unionShape_calc = unionShape_area
-        for v in list(range(0, len(fieldIdx_names))):
-        
-            expres = '"ShaShif_Ai" / "ShaShif_AT" * "' +  fieldIdx_names[v] + '"'
-            calcField(unionShape_calc, fieldIdx_temp_names[v], expres)
-        
-        
-        # add buffer of one centimeter to ensure location by position will detect all appropriate polygons
-        parameters = {'INPUT' : outShape,
-                      'DISSOLVE' : False,
-                      'DISTANCE' : 0.01,
-                      'END_CAP_STYLE' : 0,
-                      'JOIN_STYLE' : 0,
-                      'MITER_LIMIT' : 2,
-                      'SEGMENTS' : 5,
-                      'OUTPUT' : 'memory:'}
-        outShape_buf = processing.run('native:buffer', parameters)['OUTPUT']
-        
-        
-        # aggregate new values to target geometries
-        QgsMessageLog.logMessage('Aggregating new values to target geometries...', 'User notification', 0)
-        parameters = {'DISCARD_NONMATCHING' : False,
-                      'INPUT' : outShape_buf,
-                      'JOIN' : unionShape_calc,
-                      'JOIN_FIELDS' : fieldIdx_temp_names,
-                      'PREDICATE' : [1],
-                      'SUMMARIES' : [5],
-                      'OUTPUT' : 'memory:'}
-        outShape_join = processing.run('qgis:joinbylocationsummary', parameters)['OUTPUT']
-        
-        
-        # iterate over each temporary field
-        QgsMessageLog.logMessage('Transmitting values to new fields...', 'User notification', 0)
-        outShape_rename = outShape_join
-        
-        for v in list(range(0, len(fieldIdx_temp_names))):
-            
-            QgsMessageLog.logMessage('...' + str(v) + '/' + str(len(fieldIdx_temp_names)), 'User notification', 0)
-            
-            # transmit values to new fields
-            parameters = {'FIELD_LENGTH' : 10,
-                          'FIELD_NAME' : fieldIdx_names[v],
-                          'FIELD_PRECISION' : 10,
-                          'FIELD_TYPE' : 1,
-                          'FORMULA' : 'value = <' + fieldIdx_temp_names_sum[v] + '>',
-                          'GLOBAL' : '',
-                          'INPUT' : outShape_rename,
-                          'OUTPUT' : 'memory:'}
-            outShape_rename = processing.run('qgis:advancedpythonfieldcalculator', parameters)['OUTPUT']
-        
-        # delete redundant fields
-        QgsMessageLog.logMessage('Dropping redundant fields...', 'User notification', 0)
-        parameters = {'INPUT' : outShape_rename,
-                      'COLUMN' : fieldIdx_temp_names_sum,
-                      'OUTPUT' : 'memory:'}
-        outShape_done = processing.run('qgis:deletecolumn', parameters)['OUTPUT']
-        
-        
-        # write results to file
-        QgsMessageLog.logMessage('Writing results to file...', 'User notification', 0)
-        QgsVectorFileWriter.writeAsVectorFormat(outShape_done, outPath, 'ANSI', outShape.crs(), 'GPKG')
-        
-        # load result to canvas
-        QgsProject.instance().addMapLayer(outShape_done)
-        
-        
-        return {self.OUTPUT: outShape_done}
+        # measure the intersection areas of all source and target polygons once,
+        # or reuse them as long as neither geometry set changed
+        with monitor.stage('overlay') as stage:
+            if cellSize > 0:
+                # approximate the intersection areas by counting shared raster cells
+                overlay, areaReport = rasterOverlay(inShape, outShape, cellSize, monitor, prep)
+                monitor.note('areaError', areaReport)
+                for kind in ('sources', 'targets'):
+                    if kind in areaReport:
+                        QgsMessageLog.logMessage('Raster area error of %s: mean %.2f %%, max %.2f %%, %d missed' %
+                                                 (kind, 100 * areaReport[kind]['meanRelativeError'],
+                                                  100 * areaReport[kind]['maxRelativeError'], areaReport[kind]['missed']),
+                                                 'User notification', 0)
+            elif incremental:
+                # diff both layers against the previous run, if it can be continued
+                # the preparation settings are part of the state, changing them starts over
+                crs = outShape.crs().toWkt() + prep.key()
+                state = loadState(outPath, fieldIdx_names, crs)
+                tgtFids, tgtGeoms = loadGeometries(outShape)
+                srcFids, srcGeoms = loadGeometries(inShape, outShape.crs())
+                tgtGeoms = prep.apply(tgtGeoms, 'targets')
+                srcGeoms = prep.apply(srcGeoms, 'sources')
+                srcHashes = layerHashes(inShape, srcFids, srcGeoms)
+                tgtHashes = layerHashes(outShape, tgtFids, tgtGeoms, True)
+                overlay, tgtOldToNew, tgtChanged = incrementalOverlay(state, srcFids, srcGeoms, srcHashes,
+                                                                      tgtFids, tgtGeoms, tgtHashes, monitor,
+                                                                      tileSize, processes, prep)
+                if state is None:
+                    QgsMessageLog.logMessage('No previous run to continue, computing all features', 'User notification', 0)
+            elif useCache:
+                overlay, cacheHit = cachedOverlay(inShape, outShape, monitor, tileSize, processes, prep)
+                if cacheHit:
+                    QgsMessageLog.logMessage('Reusing cached area weights', 'User notification', 0)
+            else:
+                overlay = buildOverlay(inShape, outShape, monitor, tileSize, processes, prep)
+            if prep.active:
+                self.logPrep(prep.report)
+                monitor.note('geometryPrep', prep.report)
+            if weightPath:
+                saveWeightMatrix(weightPath, overlay)
+            stage.features = len(overlay)
+        
+        
+        # load the values of interest once into arrays ordered like the overlay
+        with monitor.stage('load values') as stage:
+            values = loadValues(inShape, fieldIdx, overlay.srcFids, monitor)
+            stage.features = len(overlay.srcFids)
+        
+        
+        # weight source values by the covered share of the target area and sum them per target
+        with monitor.stage('aggregate') as stage:
+            newValues = aggregateWeighted(values, overlay.src, overlay.tgt, overlay.weights(), len(overlay.tgtFids))
+            stage.features = len(overlay.tgtFids)
+        
+        
+        # update the output of the previous run in place
+        if incremental and state is not None:
+            with monitor.stage('update output') as stage:
+                outFids, n_deleted, n_added, n_updated = updateOutput(outPath, outShape, fieldIdx_names, overlay, newValues,
+                                                                      state, tgtOldToNew, tgtChanged)
+                saveRunState(statePath(outPath), overlay, srcHashes, tgtHashes, outFids, newValues, fieldIdx_names, crs)
+                stage.features = n_deleted + n_added + n_updated
+            QgsMessageLog.logMessage('Output updated: %d removed, %d added, %d changed target features' %
+                                     (n_deleted, n_added, n_updated), 'User notification', 0)
+            monitor.writeReport(reportPath)
+            return {self.OUTPUT: outPath}
+        
+        
+        # stream the target polygons with the new values straight into the output
+        with monitor.stage('write') as stage:
+            newFields = [QgsField(name, QVariant.Double) for name in fieldIdx_names if name not in outShape.fields().names()]
+            stage.features = writeLayer(outShape, outPath, fieldIdx_names, newValues, overlay.tgtFids, newFields,
+                                        monitor = monitor)
+            if incremental:
+                saveRunState(statePath(outPath), overlay, srcHashes, tgtHashes, outputFids(outPath), newValues,
+                             fieldIdx_names, crs)
+        monitor.writeReport(reportPath)
+        
+        # let the processing framework load the result when run from QGIS
+        context.addLayerToLoadOnCompletion(outPath, QgsProcessingContext.LayerDetails('outShape', context.project(),
+                                                                                      self.OUTPUT))
+        
+        
+        return {self.OUTPUT: outPath}
+    
+    
+    def logPrep(self, report):
+        
+        # summarise what the geometry preparation changed
+        for kind in ('sources', 'targets'):
+            if kind in report:
+                r = report[kind]
+                QgsMessageLog.logMessage('Prepared %s: %d of %d vertices removed, %d sliver parts dropped, area shifted %.2f %%' %
+                                         (kind, r['verticesRemoved'], r['verticesBefore'], r['sliverParts'],
+                                          100 * r['areaShifted'] / r['areaBefore'] if r['areaBefore'] > 0 else 0),
+                                         'User notification', 0)
+        if 'fragments' in report:
+            r = report['fragments']
+            QgsMessageLog.logMessage('%d intersection fragments below the minimum area dropped (%.4f %% of the overlay area)' %
+                                     (r['removed'], 100 * r['areaRemoved'] / r['areaTotal'] if r['areaTotal'] > 0 else 0),
+                                     'User notification', 0)
     
 
     def name(self):
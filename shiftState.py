@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental recomputation for shiftShapes.
+
+Every incremental run leaves a state file next to the output GeoPackage. It
+holds a 64 bit hash per source feature (geometry) and per target feature
+(geometry and attributes), the overlay and the transferred values. The next
+run diffs both layers against it:
+
+    - intersections are measured only for new or changed sources (against all
+      targets) and for new or changed targets (against unchanged sources),
+      all other pairs are taken over from the previous overlay
+    - the output is updated in place: deleted and changed targets are removed,
+      new and changed targets are added and unchanged targets are only
+      rewritten where their transferred values differ
+"""
+
+from qgis.core import (QgsFeature,
+                       QgsFeatureRequest,
+                       QgsProcessingException,
+                       QgsVectorLayer)
+import hashlib
+import numpy as np
+import os
+
+from arealEngine import (ArealOverlay,
+                         changedValues,
+                         loadRunState,
+                         matchFeatures,
+                         updatePairs)
+from arealOverlay import (intersectionAreas,
+                          tiledIntersectionAreas)
+
+
+def statePath(outPath):
+    return os.path.splitext(outPath)[0] + '.shiftState.npz'
+
+
+def featureHash(geom, attributes = None):
+    digest = hashlib.blake2b(bytes(geom.asWkb()), digest_size = 8)
+    if attributes is not None:
+        digest.update(repr(attributes).encode('utf-8'))
+    return int.from_bytes(digest.digest(), 'little')
+
+
+def layerHashes(layer, fids, geoms, withAttributes = False):
+
+    """
+    Returns a hash per feature of its geometry (and attributes) ordered like fids
+    """
+
+    if not withAttributes:
+        return np.array([featureHash(g) for g in geoms], dtype = np.uint64)
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    attributes = {feat.id(): feat.attributes() for feat in layer.getFeatures(request)}
+    return np.array([featureHash(g, attributes[int(fid)]) for fid, g in zip(fids, geoms)], dtype = np.uint64)
+
+
+def loadState(outPath, columns, crs):
+
+    """
+    Returns the state of the previous run, or None if it cannot be continued
+
+    A state is only usable for the same columns and CRS and while its output
+    still holds the features it was written with.
+    """
+
+    if not os.path.isfile(outPath):
+        return None
+    state = loadRunState(statePath(outPath))
+    if state is None or state['columns'] != list(columns) or state['crs'] != crs:
+        return None
+    out = QgsVectorLayer(outPath, 'output', 'ogr')
+    if not out.isValid() or out.featureCount() != len(state['outFids']):
+        return None
+    return state
+
+
+def incrementalOverlay(state, srcFids, srcGeoms, srcHashes, tgtFids, tgtGeoms, tgtHashes, monitor = None,
+                       tileSize = 0, processes = 1, prep = None):
+
+    """
+    Builds the overlay, measuring only pairs involving new or changed features
+
+    Without a state every pair is measured. Returns the overlay, for every old
+    target position its new position (-1 if deleted or changed) and a flag
+    per new target position telling whether it is new or changed.
+    """
+
+    targetArea = np.array([g.area() for g in tgtGeoms], dtype = np.float64)
+    if state is None:
+        if tileSize > 0:
+            src, tgt, area = tiledIntersectionAreas(srcGeoms, tgtGeoms, tileSize, processes, monitor)
+        else:
+            src, tgt, area = intersectionAreas(srcGeoms, tgtGeoms, monitor)
+        if prep is not None:
+            src, tgt, area = prep.filterPairs(src, tgt, area)
+        overlay = ArealOverlay(srcFids, tgtFids, src, tgt, area, targetArea)
+        return overlay, np.zeros(0, dtype = np.int64), np.ones(len(tgtFids), dtype = bool)
+
+    old = state['overlay']
+    srcOldToNew, srcChanged = matchFeatures(old.srcFids, state['srcHashes'], srcFids, srcHashes)
+    tgtOldToNew, tgtChanged = matchFeatures(old.tgtFids, state['tgtHashes'], tgtFids, tgtHashes)
+    changedSrc = np.flatnonzero(srcChanged)
+    keptSrc = np.flatnonzero(~srcChanged)
+    changedTgt = np.flatnonzero(tgtChanged)
+
+    # changed sources against all targets, indexing the targets and visiting the few sources
+    t, s, area = intersectionAreas(tgtGeoms, [srcGeoms[i] for i in changedSrc.tolist()])
+    parts = [(changedSrc[s], t, area)]
+
+    # changed targets against the unchanged sources
+    s, t, area = intersectionAreas([srcGeoms[i] for i in keptSrc.tolist()], [tgtGeoms[j] for j in changedTgt.tolist()])
+    parts.append((keptSrc[s], changedTgt[t], area))
+    if prep is not None:
+        parts = [prep.filterPairs(*part) for part in parts]
+
+    src, tgt, area = updatePairs(old, srcOldToNew, tgtOldToNew, parts)
+    return ArealOverlay(srcFids, tgtFids, src, tgt, area, targetArea), tgtOldToNew, tgtChanged
+
+
+def updateOutput(outPath, targetLayer, fieldNames, overlay, values, state, tgtOldToNew, tgtChanged):
+
+    """
+    Updates the output GeoPackage of the previous run in place
+
+    Returns the output fids ordered like the targets and the numbers of
+    deleted, added and updated output features.
+    """
+
+    out = QgsVectorLayer(outPath, 'output', 'ogr')
+    provider = out.dataProvider()
+    outFields = out.fields()
+    outIdx = [outFields.indexOf(name) for name in fieldNames]
+    outFids = np.full(len(overlay.tgtFids), -1, dtype = np.int64)
+
+    # remove targets which were deleted or changed
+    kept = np.flatnonzero(tgtOldToNew >= 0)
+    outFids[tgtOldToNew[kept]] = state['outFids'][kept]
+    deleted = state['outFids'][tgtOldToNew < 0]
+    if len(deleted):
+        provider.deleteFeatures(deleted.tolist())
+
+    # rewrite the values of unchanged targets only where they differ
+    newPos = tgtOldToNew[kept]
+    differs = changedValues(state['values'][:, kept], values[:, newPos])
+    attMap = {}
+    for pos in newPos[differs].tolist():
+        attMap[int(outFids[pos])] = {outIdx[v]: (None if np.isnan(values[v, pos]) else float(values[v, pos]))
+                                     for v in list(range(0, len(outIdx)))}
+    if attMap:
+        provider.changeAttributeValues(attMap)
+
+    # add new and changed targets with all their attributes
+    added = np.flatnonzero(tgtChanged)
+    if len(added):
+        position = {int(overlay.tgtFids[pos]): pos for pos in added.tolist()}
+        skip = set(provider.pkAttributeIndexes())
+        feats = []
+        addedPos = []
+        request = QgsFeatureRequest().setFilterFids(list(position))
+        for feat in targetLayer.getFeatures(request):
+            pos = position[feat.id()]
+            newFeat = QgsFeature(outFields)
+            newFeat.setGeometry(feat.geometry())
+            for name in feat.fields().names():
+                idx = outFields.indexOf(name)
+                if idx >= 0 and idx not in skip:
+                    newFeat[idx] = feat[name]
+            for v in list(range(0, len(outIdx))):
+                newFeat[outIdx[v]] = None if np.isnan(values[v, pos]) else float(values[v, pos])
+            feats.append(newFeat)
+            addedPos.append(pos)
+        ok, feats = provider.addFeatures(feats)
+        if not ok:
+            raise QgsProcessingException('Could not add the new target features to ' + outPath)
+        outFids[addedPos] = [feat.id() for feat in feats]
+    return outFids, len(deleted), len(added), len(attMap)
+
+
+def outputFids(outPath):
+
+    # fids of a freshly written output in their natural order, which is the target order
+    out = QgsVectorLayer(outPath, 'output', 'ogr')
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setNoAttributes()
+    return np.fromiter((feat.id() for feat in out.getFeatures(request)), dtype = np.int64)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk loader for QGIS attribute tables into pandas data frames.
+
+Only the requested columns are read and geometries are skipped. For file based
+OGR layers the table is streamed as Arrow record batches through GDAL (3.8 or
+newer); all other layers are read through a single QgsFeatureRequest. Either way
+every column is converted into a typed array in one step.
+"""
+
+from PyQt5.QtCore import QVariant
+from qgis.core import (QgsFeatureRequest,
+                       QgsProviderRegistry)
+import numpy as np
+import pandas as pd
+
+try:
+    from osgeo import gdal, ogr
+except ImportError:
+    gdal = None
+
+
+INT_TYPES = (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong)
+
+
+def isNull(val):
+    return val is None or (isinstance(val, QVariant) and val.isNull())
+
+
+def toColumn(vals, fieldType):
+
+    """
+    Converts a list of attribute values into a typed array or series
+    """
+
+    nulls = [isNull(v) for v in vals]
+    hasNulls = any(nulls)
+    if fieldType in INT_TYPES:
+        if not hasNulls:
+            return np.array(vals, dtype = np.int64)
+        return pd.array([None if n else v for v, n in zip(vals, nulls)], dtype = 'Int64')
+    if fieldType == QVariant.Double:
+        return np.array([np.nan if n else v for v, n in zip(vals, nulls)], dtype = np.float64)
+    if fieldType == QVariant.Bool:
+        if not hasNulls:
+            return np.array(vals, dtype = bool)
+        return pd.array([None if n else v for v, n in zip(vals, nulls)], dtype = 'boolean')
+    if fieldType == QVariant.Date:
+        return pd.to_datetime([None if n or not v.isValid() else v.toPyDate() for v, n in zip(vals, nulls)])
+    if fieldType == QVariant.DateTime:
+        return pd.to_datetime([None if n or not v.isValid() else v.toPyDateTime() for v, n in zip(vals, nulls)])
+    return np.array([None if n else v for v, n in zip(vals, nulls)], dtype = object)
+
+
+def qgisBatches(layer, columns, batchSize = None, monitor = None):
+
+    # read the requested attributes without geometries, batchSize features at a time
+    fields = layer.fields()
+    fieldIdx = [fields.indexFromName(c) for c in columns]
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(fieldIdx)
+    n_feats = layer.featureCount()
+
+    def toFrame(cols):
+        return pd.DataFrame({c: toColumn(vals, fields.at(idx).type())
+                             for c, vals, idx in zip(columns, cols, fieldIdx)},
+                            columns = columns)
+
+    cols = [[] for c in columns]
+    i = 0
+    pending = 0
+    for feat in layer.getFeatures(request):
+        atts = feat.attributes()
+        for c, idx in enumerate(fieldIdx):
+            cols[c].append(atts[idx])
+        i += 1
+        pending += 1
+        if monitor is not None and i % 1000 == 0:
+            monitor.progress(i, n_feats)
+        if batchSize and pending >= batchSize:
+            yield toFrame(cols)
+            cols = [[] for c in columns]
+            pending = 0
+    if i == 0 or not batchSize or pending:
+        yield toFrame(cols)
+
+
+def arrowColumn(arrays):
+
+    # merge the batches of one column and translate masks, bytes and nulls
+    if any(isinstance(a, np.ma.MaskedArray) for a in arrays):
+        arr = np.ma.concatenate(arrays)
+        if arr.dtype.kind in 'iu':
+            return pd.arrays.IntegerArray(arr.data.astype(np.int64), np.ma.getmaskarray(arr))
+        if arr.dtype.kind == 'b':
+            return pd.arrays.BooleanArray(arr.data, np.ma.getmaskarray(arr))
+        return arr.astype(np.float64).filled(np.nan) if arr.dtype.kind == 'f' else arr.filled(None)
+    arr = np.concatenate(arrays) if arrays else np.array([], dtype = object)
+    if arr.dtype == object:
+        arr = np.array([v.decode('utf-8') if isinstance(v, bytes) else v for v in arr], dtype = object)
+    return arr
+
+
+def arrowBatches(layer, columns, batchSize = None, monitor = None):
+
+    """
+    Streams the requested columns of an OGR layer as Arrow batches, None if not possible
+    """
+
+    # masked arrays for numeric NULLs arrived with GDAL 3.8, before that they
+    # would come out as 0 instead of the NaN / <NA> of the QGIS path
+    if gdal is None or int(gdal.VersionInfo()) < 3080000:
+        return None
+    if layer.providerType() != 'ogr' or layer.subsetString():
+        return None
+    parts = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+    if not parts.get('path'):
+        return None
+
+    ds = ogr.Open(parts['path'])
+    if ds is None:
+        return None
+    if parts.get('layerName'):
+        ogrLayer = ds.GetLayerByName(parts['layerName'])
+    else:
+        ogrLayer = ds.GetLayer(parts.get('layerId') or 0)
+    if ogrLayer is None:
+        return None
+
+    # columns only known to QGIS (e.g. virtual fields) need the QGIS path
+    defn = ogrLayer.GetLayerDefn()
+    names = [defn.GetFieldDefn(i).GetName() for i in list(range(0, defn.GetFieldCount()))]
+    fidColumn = ogrLayer.GetFIDColumn()
+    if any(c not in names and c != fidColumn for c in columns):
+        return None
+
+    # ignore geometries and all attributes which are not requested
+    ignored = [n for n in names if n not in columns] + ['OGR_GEOMETRY']
+    if ogrLayer.SetIgnoredFields(ignored) != 0:
+        return None
+    includeFid = bool(fidColumn) and fidColumn in columns
+    stream = ogrLayer.GetArrowStreamAsNumPy(['INCLUDE_FID=' + ('YES' if includeFid else 'NO'),
+                                             'MAX_FEATURES_IN_BATCH=' + str(batchSize or 65536),
+                                             'USE_MASKED_ARRAYS=YES'])
+    n_feats = layer.featureCount()
+
+    # the data source has to stay open until the stream is exhausted
+    def batches(dataSource):
+        done = 0
+        for batch in stream:
+            done += len(batch[columns[0]]) if columns else 0
+            if monitor is not None:
+                monitor.progress(done, n_feats)
+            yield batch
+
+    return batches(ds)
+
+
+def iterAttributeBatches(layer, columns = None, batchSize = 50000, monitor = None):
+
+    """
+    Yields the given columns (default: all) of a layer as data frames of at most batchSize rows
+    """
+
+    if columns is None:
+        columns = layer.fields().names()
+    columns = list(columns)
+    try:
+        stream = arrowBatches(layer, columns, batchSize, monitor)
+    except (RuntimeError, AttributeError):
+        # older bindings without Arrow support or a driver without a stream interface
+        stream = None
+    if stream is None:
+        for frame in qgisBatches(layer, columns, batchSize, monitor):
+            yield frame
+        return
+    for batch in stream:
+        yield pd.DataFrame({c: arrowColumn([batch[c]]) for c in columns}, columns = columns)
+
+
+def loadAttributeTable(layer, columns = None, monitor = None):
+
+    """
+    Loads the given columns (default: all) of a layer into a data frame
+    """
+
+    if columns is None:
+        columns = layer.fields().names()
+    columns = list(columns)
+    try:
+        stream = arrowBatches(layer, columns, None, monitor)
+    except (RuntimeError, AttributeError):
+        stream = None
+    if stream is None:
+        return next(qgisBatches(layer, columns, None, monitor))
+
+    # merge all batches per column before building the frame
+    batches = {c: [] for c in columns}
+    for batch in stream:
+        for c in columns:
+            batches[c].append(batch[c])
+    return pd.DataFrame({c: arrowColumn(batches[c]) for c in columns}, columns = columns)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch writers for encoded tables.
+
+The output format is chosen by file extension:
+
+    .csv                UTF-8 text, written in chunks
+    .parquet            compressed Parquet (requires pyarrow)
+    .feather / .arrow   compressed Feather v2 / Arrow IPC file (requires pyarrow)
+    .gpkg               GeoPackage attribute table (requires GDAL)
+
+A writer is opened once and receives the table in one or more data frames with
+identical columns, so the same code serves the in-memory and the streaming
+modes of the encoders.
+"""
+
+import os
+import pandas as pd
+import sqlite3
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    from osgeo import ogr
+except ImportError:
+    ogr = None
+
+
+# file filter for QgsProcessingParameterFileDestination
+FILE_FILTER = ('CSV files (*.csv);;Parquet files (*.parquet);;Feather files (*.feather);;'
+               'GeoPackage attribute table (*.gpkg)')
+
+CSV_CHUNK_ROWS = 100000
+
+
+def quoteIdentifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def arrowSchema(frame):
+
+    """
+    Derives the Arrow schema of a table from its first batch
+
+    A column holding only NULLs in the first batch gets the Arrow null type,
+    which no later batch with real values could be written to. Such columns
+    can only be object columns of text fields, so they are widened to string.
+    """
+
+    schema = pa.Schema.from_pandas(frame, preserve_index = False)
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+    return schema
+
+
+def gpkgColumn(series):
+
+    # GeoPackage field type of a column and the converter of its values into a
+    # list, converters cast to the field type so they fit whatever dtype a later batch has
+    kind = series.dtype.kind
+    if kind in 'iub':
+        return ogr.OFTInteger64, lambda s: [None if pd.isna(v) else int(v) for v in s.astype(object)]
+    if kind == 'f':
+        return ogr.OFTReal, lambda s: [None if pd.isna(v) else float(v) for v in s.astype(object)]
+    if kind == 'M':
+        return ogr.OFTDateTime, lambda s: [None if pd.isna(v) else v
+                                           for v in pd.to_datetime(s).dt.strftime('%Y-%m-%dT%H:%M:%S')]
+    return ogr.OFTString, lambda s: [None if pd.isna(v) else str(v) for v in s.astype(object)]
+
+
+class TableWriter(object):
+
+    """
+    Appends data frames to a CSV, Parquet, Feather or GeoPackage table
+    """
+
+    def __init__(self, path, layerName = None):
+        self.path = path
+        self.ext = os.path.splitext(path)[1].lower()
+        self.layerName = layerName or os.path.splitext(os.path.basename(path))[0]
+        self.columns = None
+        self.rows = 0
+        self.writer = None
+        self.sink = None
+        self.schema = None
+        if self.ext in ('.parquet', '.feather', '.arrow') and pa is None:
+            raise RuntimeError('Writing ' + self.ext + ' files requires the pyarrow package')
+        if self.ext == '.gpkg' and ogr is None:
+            raise RuntimeError('Writing GeoPackage tables requires the GDAL Python bindings')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def write(self, frame):
+
+        """
+        Appends one data frame, the first one defines the columns
+        """
+
+        frame = frame.rename(columns = str)
+        if self.columns is None:
+            self.columns = list(frame.columns)
+            if self.ext != '.csv' and len(set(self.columns)) != len(self.columns):
+                duplicates = sorted(set(c for c in self.columns if self.columns.count(c) > 1))
+                raise ValueError('Duplicate output column names: ' + ', '.join(duplicates))
+            self.open(frame)
+        if self.ext in ('.parquet', '.feather', '.arrow'):
+            self.writer.write_table(pa.Table.from_pandas(frame, schema = self.schema, preserve_index = False))
+        elif self.ext == '.gpkg':
+            self.insertRows(frame)
+        else:
+            frame.to_csv(self.path, index = False, encoding = 'utf-8', mode = 'a', header = self.rows == 0,
+                         chunksize = CSV_CHUNK_ROWS)
+        self.rows += len(frame)
+
+    def open(self, frame):
+
+        # create the output with the schema of the first batch
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.ext == '.parquet':
+            self.schema = arrowSchema(frame)
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression = 'zstd')
+        elif self.ext in ('.feather', '.arrow'):
+            self.schema = arrowSchema(frame)
+            self.sink = pa.OSFile(self.path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, self.schema,
+                                          options = pa.ipc.IpcWriteOptions(compression = 'zstd'))
+        elif self.ext == '.gpkg':
+            self.createGpkgTable(frame)
+
+    def createGpkgTable(self, frame):
+
+        # let GDAL create a valid GeoPackage attribute table, rows are inserted with sqlite
+        ds = ogr.GetDriverByName('GPKG').CreateDataSource(self.path)
+        layer = ds.CreateLayer(self.layerName, geom_type = ogr.wkbNone, options = ['FID=fid'])
+        self.converters = []
+        for c in self.columns:
+            fieldType, convert = gpkgColumn(frame[c])
+            layer.CreateField(ogr.FieldDefn(c, fieldType))
+            self.converters.append(convert)
+        layer = None
+        ds = None
+
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA journal_mode = MEMORY')
+        self.insertSql = 'INSERT INTO %s (%s) VALUES (%s)' % (quoteIdentifier(self.layerName),
+                                                              ', '.join(quoteIdentifier(c) for c in self.columns),
+                                                              ', '.join('?' for c in self.columns))
+
+    def insertRows(self, frame):
+
+        # insert one batch inside a single transaction
+        cols = [convert(frame[c]) for c, convert in zip(self.columns, self.converters)]
+        with self.connection:
+            self.connection.executemany(self.insertSql, zip(*cols))
+
+    def close(self):
+
+        """
+        Finishes the file, an empty table is written if no batch arrived
+        """
+
+        if self.columns is None:
+            self.write(pd.DataFrame())
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+        if self.ext == '.gpkg' and getattr(self, 'connection', None) is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def writeTable(path, frame):
+
+    """
+    Writes a complete data frame in one go
+    """
+
+    with TableWriter(path) as writer:
+        writer.write(frame)
+    return path